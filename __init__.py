@@ -28,6 +28,7 @@ DIMS  = {}
 HIERS = {}
 CUBES = {}
 FORMULAS = {}
+FORMULA_DEPENDENCIES = {}   # cube code: codes of the formulas reading the cube
 DIMS_IN_USE = set()
 MODIFIED_CUBES = set()
 
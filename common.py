@@ -24,6 +24,7 @@ def reset_global_vars():
     cubely.DIMS_IN_USE = set()
     cubely.CUBES = {}
     cubely.FORMULAS = {}
+    cubely.FORMULA_DEPENDENCIES = {}
 
 
 def get_collection_name(objectType, parentCode = False, objectCode = False):
@@ -79,6 +80,35 @@ def find_keys(dic, val):
     """return the key of dictionary dic given the value"""
     return [k for k, v in dic.iteritems() if v == val]
 
+
+def ordinals_to_bits(ordinals):
+    """Return a bitset (long) with the bits of the ordinals set"""
+    ordinals = list(ordinals)
+    if not ordinals:
+        return 0L
+    # build the binary representation in one pass rather than shifting bit by bit
+    digits = bytearray('0' * (max(ordinals) + 1))
+    for ordinal in ordinals:
+        digits[ordinal] = '1'
+    digits.reverse()
+    return long(str(digits), 2)
+
+
+def bits_to_ordinals(bits):
+    """Return the ordinals of the bits set in a bitset (long), in increasing order"""
+    digits = bin(bits)[:1:-1]
+    ordinals = []
+    ordinal = digits.find('1')
+    while ordinal >= 0:
+        ordinals.append(ordinal)
+        ordinal = digits.find('1', ordinal + 1)
+    return ordinals
+
+
+def count_bits(bits):
+    """Return the number of bits set in a bitset (long)"""
+    return bin(bits).count('1')
+
 def get_dim_object(dim):
     if dim.__class__ == cubely.core.Dimension:
         dimObj = dim
@@ -127,33 +157,110 @@ def product(*args, **kwds):
     for prod in result:
         yield tuple(prod)
 
-def get_status_nuplet(dimList):
-    dimStatus = {}
-    positionsToCompute = []
-    queryList = []
-    dimIndex = 0
+def bulk_write(collection, operations, batchSize, upsert=True):
+    """
+    Send (selector, document) update operations to a collection as unordered
+    bulk operations of batchSize operations. Return the number of operations sent.
+
+    Keywords arguments:
+    collection -- pymongo collection to write to
+    operations -- iterable of (selector, document) tuples
+    batchSize -- number of operations per bulk execution
+    upsert -- insert the document when the selector matches nothing (default True)
+
+    """
+    count = 0
+    bulk = None
+    for selector, document in operations:
+        if bulk is None:
+            try:
+                bulk = collection.initialize_unordered_bulk_op()
+            except AttributeError:
+                # pymongo < 2.7 has no bulk API, fall back to one update per operation
+                collection.update(selector, document, upsert=upsert)
+                count += 1
+                continue
+        if upsert:
+            bulk.find(selector).upsert().update(document)
+        else:
+            bulk.find(selector).update(document)
+        count += 1
+        if count % batchSize == 0:
+            bulk.execute()
+            bulk = None
+    if bulk is not None:
+        bulk.execute()
+    return count
+
+def get_status_restrict(dimList):
+    """Return the lists of position codes in status, by dimension code"""
+    restrict = {}
     for dim in dimList:
         dimObj = cubely.common.get_dim_object(dim)
-        dimStatus[dimObj.code] = [pos.code for pos in dimObj.status]
+        restrict[dimObj.code] = [pos.code for pos in dimObj.status]
+    return restrict
+
+
+def iter_status_cells(cube, dimList=None):
+    """
+    Iterate over the stored cells of a cube in the status of its dimensions.
+    Yield (position dict, value) tuples. The statuses are read when the function
+    is called, not when the iteration starts.
+
+    Keywords arguments:
+    cube -- cubely.Cube object to read
+    dimList -- dimensions whose status limits the cells (default None, all the dimensions of the cube)
+
+    """
+    if dimList is None:
+        dimList = cube.dimensions
+    return cube.stored_cells(get_status_restrict(dimList))
+
+
+def iter_status_nuplet(dimList, cube=None):
+    """
+    Iterate lazily over the cross product of the statuses of dimensions. Yield
+    position dicts. The statuses are read when the function is called, not when
+    the iteration starts.
+
+    Keywords arguments:
+    dimList -- dimensions to combine
+    cube -- if given, only yield the positions of the stored cells of this cube (default None)
+
+    """
+    if cube is not None:
+        return (cell for cell, cellVal in iter_status_cells(cube, dimList))
+    dimStatus = get_status_restrict(dimList)
+    dimCodes = dimStatus.keys()
     try:
         # Python 2.6+ version
-        [positionsToCompute.append(el) for el in itertools.product(*dimStatus.values())]
+        nuplets = itertools.product(*[dimStatus[d] for d in dimCodes])
     except AttributeError:
         # Python 2.5 version
-        [positionsToCompute.append(el) for el in cubely.common.product(*dimStatus.values())]
-    #print positionsToCompute
-    for nuplet in positionsToCompute:
-        dimIndex = 0
-        tmpDict = {}
-        for element in nuplet:
-            tmpDict[dimStatus.keys()[dimIndex]] = element
-            dimIndex += 1
-        queryList.append(tmpDict)
-    return queryList
-
-def get_position_tuple(posDict, silent_error=False):
+        nuplets = cubely.common.product(*[dimStatus[d] for d in dimCodes])
+    return (dict(zip(dimCodes, nuplet)) for nuplet in nuplets)
+
+
+def get_status_nuplet(dimList):
+    """Return the list of the position dicts of the cross product of the statuses of dimensions"""
+    return list(iter_status_nuplet(dimList))
+
+def get_position_tuple(posDict, dims=None, silent_error=False):
+    """
+    Return the tuple of position codes of a cell.
+
+    Keywords arguments:
+    posDict -- dict of position codes by dimension code
+    dims -- dimension codes giving the order of the tuple (default posDict order)
+    silent_error -- skip the invalid positions instead of raising (default False)
+
+    """
     dimsTup = []
-    for d in posDict.keys():
+    if dims is None:
+        dims = posDict.keys()
+    for d in dims:
+        if not posDict.has_key(d):
+            raise CubeError(d, 'Invalid dimension for cube')
         if cubely.DIMS[d].positions.has_key(posDict[d]):
             dimsTup.append(posDict[d])
         else:
@@ -4,18 +4,29 @@
 # *** Imports
 from operator import truediv
 from operator import neg
+import operator
 import copy
+import time
+import itertools
 from threading import Lock
 from types import NoneType
 from types import IntType
 from types import LongType
 from types import FloatType
+try:
+    # Python 2.7+
+    from collections import OrderedDict
+except ImportError:
+    # no LRU order, the formula caches evict arbitrary cells
+    OrderedDict = dict
 
 from pymongo import ASCENDING
 
 import cubely
 import cubely.core
 import cubely.common
+import cubely.storage
+import cubely.expression
 
 from cubely.errors import DatabaseError
 from cubely.errors import DimensionError
@@ -26,6 +37,23 @@ from cubely.errors import FormulaError
 from cubely.errors import RelationError
 from cubely.errors import HierarchyError
 
+# *** Module global vars
+UPDATE_BATCH_SIZE = 5000    # number of cells sent to mongodb per bulk operation
+FORMULA_CACHE_SIZE = 100000 # max number of cells cached per formula, the least recently used are evicted
+GET_MANY_BATCH_SIZE = 1000  # max number of cells selected by one $or query of Cube.get_many
+INSERT_BATCH_SIZE = 10000   # number of positions inserted in mongodb per batch by Dimension.add_positions
+# cube arithmetic: operator function, and cells computed (union or intersection
+# of the stored cells of both operands, or the stored cells of the left one)
+CUBE_OPERATORS = {
+    'add': (operator.add, 'union'),
+    'sub': (operator.sub, 'union'),
+    'mul': (operator.mul, 'intersection'),
+    'div': (operator.truediv, 'intersection'),
+    'fdv': (operator.floordiv, 'intersection'),
+    'mod': (operator.mod, 'intersection'),
+    'pow': (operator.pow, 'left'),
+}
+
 # *** Classes definition
 class Database(object):
     """Cubely database. Each one correspond to one mongodb namespace. Singleton."""
@@ -71,9 +99,11 @@ class Database(object):
 
     Keywords arguments:
     name -- Name of the db to open
+    lazy -- read the positions of the dimensions and the links of the
+            hierarchies on first use only (default False)
 
     """
-    def open(self, name):
+    def open(self, name, lazy=False):
         # connect to the database
         self.db = cubely.CONNECTION[name]
         existingCols = self.db.collection_names()
@@ -85,12 +115,12 @@ class Database(object):
             self.description = self.metas.find_one({'code': 'description'})
             # dims instanciation
             for dim in self.metas.find_one({'code': 'dims'})[u'value']:
-                cubely.DIMS[dim['code']] = cubely.dim._get(dim['code'])
+                cubely.DIMS[dim['code']] = cubely.dim._get(dim['code'], dim, lazy)
                 tmpCode = 'cubely.D_' + dim['code'] + ' = cubely.DIMS[\'' + dim['code'] + '\']'
                 exec(tmpCode)
             # cubes instanciation
             for var in self.metas.find_one({'code': 'cubes'})[u'value']:
-                cubely.CUBES[var['code']] = cubely.cube._get(var['code'])
+                cubely.CUBES[var['code']] = cubely.cube._get(var['code'], var)
                 tmpCode = 'cubely.V_' + var['code'] + ' = cubely.CUBES[\'' + var['code'] + '\']'
                 exec(tmpCode)
             for var in cubely.CUBES.values():
@@ -99,15 +129,16 @@ class Database(object):
             # Formulas instanciation
             for var in self.metas.find_one({'code': 'formulas'})[u'value']:
                 #print var
-                cubely.FORMULAS[var['code']] = cubely.formula._get(var['code'])
+                cubely.FORMULAS[var['code']] = cubely.formula._get(var['code'], var)
                 tmpCode = 'cubely.F_' + var['code'] + ' = cubely.FORMULAS[\'' + var['code'] + '\']'
                 exec(tmpCode)
             # hierarchies instanciation
             for hier in self.metas.find_one({'code': 'hiers'})[u'value']:
                 if hier['dim'] not in cubely.HIERS.keys():
                     cubely.HIERS[hier['dim']] = {}
-                cubely.HIERS[hier['dim']][hier['code']] = cubely.hier._get(hier['dim'], hier['code'])
-                # ensure the hierarchies are indexed for hierarchical sorting
+                cubely.HIERS[hier['dim']][hier['code']] = cubely.hier._get(hier['dim'], hier['code'], hier, lazy)
+                # ensure the hierarchies are indexed for hierarchical sorting,
+                # check_hier skips the ones that did not change since they were last indexed
                 cubely.lang.check_hier(cubely.HIERS[hier['dim']][hier['code']])
             # Relations instanciation
             for var in self.metas.find_one({'code': 'relations'})[u'value']:
@@ -206,6 +237,9 @@ class Database(object):
             raise DatabaseError('','No open database to update')
         for cubeCode in cubely.CUBES:
             cubely.CUBES[cubeCode].update()
+        # materialized formulas write back their refreshed cells
+        for formulaCode in cubely.FORMULAS:
+            cubely.FORMULAS[formulaCode].update()
 
 
 class Dimension(object):
@@ -213,39 +247,61 @@ class Dimension(object):
     code = ''
     abrev = ''
     description = u''
-    positions = {}
     positionCollection = None
     hierarchies = {}
-    status = []
     iterationCount = 0
+    # positions, _ordinals and _ordered are instance attributes only: the
+    # dimensions opened lazily read them on first use (see __getattr__)
+    _lazy = False
+    # alphabetical sort keys by position code, computed once per position
+    _alphaKeys = {}
+    # status bitset over the position ordinals (index in _ordered)
+    _statusBits = 0L
+    _pendingStatus = []
+    _statusList = []
+    _allBits = None
 
     def __iter__(self):
         self.iterationCount = 0
         return self
 
+    def __getattr__(self, name):
+        # only called for the attributes not set yet
+        if self._lazy and name in ('positions', '_ordinals', '_ordered'):
+            self._load_positions()
+            return getattr(self, name)
+        raise AttributeError(name)
+
     """Clear the instance properties. Private."""
     def _clear(self):
         self.code = ''
         self.abrev = ''
         self.description = u''
+        self._lazy = False
+        self._alphaKeys = {}
         self.positions = {}
         self.positionCollection = None
         self.hierarchies = {}
-        self.status = []
         self.iterationCount = 0
+        self._ordinals = {}
+        self._ordered = []
+        self._statusBits = 0L
+        self._pendingStatus = []
+        self._statusList = []
+        self._allBits = None
 
     def __str__(self):
         return '(dimension ' + self.code + ') ' + self.description
 
     def next(self):
-        if self.statlen() == 0:
-            raise StopIteration
-        elif self.iterationCount >= self.statlen():
+        # the status list is kept until the status changes
+        statusList = self.status
+        if self.iterationCount >= len(statusList):
             self.iterationCount = 0
             raise StopIteration
         else:
             self.iterationCount += 1
-            return self.status[self.iterationCount - 1]
+            return statusList[self.iterationCount - 1]
 
     """
     Create a new dimension. Singleton. Return the dimension object.
@@ -289,18 +345,20 @@ class Dimension(object):
             raise DimensionError(code, 'Dimension in use')
         if code in cubely.HIERS.keys():
             for hier in cubely.HIERS[code]:
-                cubely.db.db.drop_collection(cubely.common.get_collection_name('hier', self.code, hier))
-                cubely.common.delete_meta_double('hiers', 'dim', self.code, hier)
+                cubely.db.db.drop_collection(cubely.common.get_collection_name('hier', code, hier))
+                cubely.common.delete_meta_double('hiers', 'dim', code, hier)
             del cubely.HIERS[code]
         if code in cubely.DIMS.keys():
+            # the singleton holds no positions: work on the dimension itself
+            dim = cubely.DIMS[code]
             # Delete the positions first
             ## we must copy the positions list first cause its gonna be modified while we're iterating
-            posList = copy.deepcopy(self.positions)
+            posList = list(dim.positions.keys())
             for pos in posList:
-                self.delete_position(pos)
+                dim.delete_position(pos)
             del(posList)
             # Delete the positions representation in mongo
-            cubely.db.db.drop_collection(cubely.common.get_collection_name('pos', self.code))
+            cubely.db.db.drop_collection(cubely.common.get_collection_name('pos', code))
             # Clean up memory
             del(cubely.DIMS[code])
             exec('del(cubely.D_'+code+')')
@@ -325,10 +383,62 @@ class Dimension(object):
             self.positions[code] = newPos
             if newPos.dimension != self.code:
                 raise DimensionError(self, 'The position you want to add in status does not belong to the dimension')
-            self.status.append(newPos)
+            self._add_ordinal(newPos)
+            # new positions are added to the status, the bitset is merged on next use
+            self._pendingStatus.append(self._ordinals[code])
+            if self._statusList is not None:
+                self._statusList.append(newPos)
             newPos.save()
             return newPos
 
+    """
+    Add many new positions to the dimension at once. The codes are checked in
+    memory and the positions inserted in batches. Return the list of the new
+    position objects.
+
+    Keywords arguments:
+    positions -- iterable of position codes or (code, description) tuples
+    skip_existing -- ignore the positions that already exist instead of raising (default False)
+    batchSize -- number of positions inserted per batch (default INSERT_BATCH_SIZE)
+
+    """
+    def add_positions(self, positions, skip_existing=False, batchSize=None):
+        if batchSize is None:
+            batchSize = INSERT_BATCH_SIZE
+        newPositions = []
+        newCodes = set()
+        existingCodes = []
+        for position in positions:
+            if position.__class__ in [tuple, list]:
+                code, desc = position
+            else:
+                code, desc = position, None
+            if code in self.positions or code in newCodes:
+                existingCodes.append(code)
+                continue
+            newCodes.add(code)
+            newPositions.append(Position(self.code, code, desc))
+        # nothing is added when a position already exists
+        if existingCodes and not skip_existing:
+            raise PositionAlreadyExistsError(existingCodes, 'Positions already exist: ' + ', '.join(existingCodes))
+        for newPos in newPositions:
+            self.positions[newPos.code] = newPos
+            self._add_ordinal(newPos)
+        # new positions are added to the status, the bitset is merged on next use
+        self._pendingStatus.extend([self._ordinals[newPos.code] for newPos in newPositions])
+        if self._statusList is not None:
+            self._statusList.extend(newPositions)
+        for batchStart in range(0, len(newPositions), batchSize):
+            batch = newPositions[batchStart:batchStart + batchSize]
+            self.positionCollection.insert([{'code': newPos.code, 'desc': newPos.description} for newPos in batch])
+        return newPositions
+
+    def _add_ordinal(self, pos):
+        """Give the next ordinal to a position. Private."""
+        self._ordinals[pos.code] = len(self._ordered)
+        self._ordered.append(pos)
+        self._allBits = None
+
     """
     Delete an existing position.
 
@@ -339,8 +449,13 @@ class Dimension(object):
     def delete_position(self, code):
         if self.positions.has_key(code):
             pos = self.positions[code]
-            if pos in self.status:
-                self.status.remove(pos)
+            if code in self._ordinals:
+                self._status_modify_bits(1L << self._ordinals[code], 'remove')
+                # ordinals are never reused
+                self._ordered[self._ordinals[code]] = None
+                del self._ordinals[code]
+                self._allBits = None
+            self._alphaKeys.pop(code, None)
             pos.requested_deletion = True
             pos.delete()
             del pos
@@ -366,27 +481,143 @@ class Dimension(object):
 
     Keywords arguments:
     code -- Code of the dimension to instanciate
+    spec -- meta entry of the dimension (default None, read from the meta collection)
+    lazy -- read the positions on first use only (default False)
 
     """
-    def _get(self, code):
+    def _get(self, code, spec=None, lazy=False):
         self._clear()
         self.code = code.upper()
-        self.positions = {}
         colName = cubely.common.get_collection_name('pos', self.code)
-        self.description = [item['desc'] for item in cubely.db.metas.find_one({'code': 'dims'})[u'value'] if item['code'] == self.code][0]
+        if spec is None:
+            spec = [item for item in cubely.db.metas.find_one({'code': 'dims'})[u'value'] if item['code'] == self.code][0]
+        self.description = spec['desc']
         self.positionCollection = cubely.db.db[colName]
-        positions = cubely.db.db[colName].find()
-        for pos in positions:
+        if lazy:
+            del self.positions, self._ordinals, self._ordered
+            self._lazy = True
+        else:
+            self._load_positions()
+        dimCopy = copy.copy(self)
+        # the singleton must not load the positions of the dimension
+        self._clear()
+        return dimCopy
+
+    def _load_positions(self):
+        """Read the positions of the dimension from mongodb. Private."""
+        self._lazy = False
+        self.positions = {}
+        self._ordinals = {}
+        self._ordered = []
+        self._allBits = None
+        for pos in self.positionCollection.find():
             self.positions[pos['code']] = Position(self.code, pos['code'], pos['desc'])
-        return copy.copy(self)
+            self._add_ordinal(self.positions[pos['code']])
 
     def statlen(self):
         """Return the number of positions currently in status for the dimension. Return Int."""
+        # the status list is built once per status change, its length is free afterwards
         return len(self.status)
 
+    def _get_status_bits(self):
+        """Return the status as a bitset over the position ordinals. Private."""
+        if self._pendingStatus:
+            self._statusBits |= cubely.common.ordinals_to_bits(self._pendingStatus)
+            self._pendingStatus = []
+        return self._statusBits
+
+    def _get_all_bits(self):
+        """Return the bitset of all the positions of the dimension. Private."""
+        if self._allBits is None:
+            self._allBits = cubely.common.ordinals_to_bits(self._ordinals.itervalues())
+        return self._allBits
+
+    def _get_status(self):
+        """
+        Return the positions in status, as a list. The list is built in ordinal
+        order and kept until the status changes, so it can be sorted in place.
+        """
+        if self._statusList is None:
+            ordered = self._ordered
+            self._statusList = [ordered[o] for o in cubely.common.bits_to_ordinals(self._get_status_bits())]
+        return self._statusList
+
+    def _set_status(self, positions):
+        """Set the status to a list of positions, keeping its order"""
+        ordinals = []
+        seen = set()
+        for ordinal in self._get_ordinals(positions):
+            if ordinal not in seen:
+                seen.add(ordinal)
+                ordinals.append(ordinal)
+        self._statusBits = cubely.common.ordinals_to_bits(ordinals)
+        self._pendingStatus = []
+        self._statusList = [self._ordered[o] for o in ordinals]
+
+    status = property(_get_status, _set_status)
+
     def status_clear(self):
         """Clear the status of the dimension"""
-        self.status = []
+        self._statusBits = 0L
+        self._pendingStatus = []
+        self._statusList = []
+
+    def _get_ordinals(self, positions, silent=False):
+        """
+        Return the ordinals of a list of positions, position codes or position
+        dicts. Private.
+
+        Keywords arguments:
+        positions -- list of postions of the dimension
+        silent -- if True, ignore the positions that do not exist (default False)
+
+        """
+        ordinals = []
+        unknownCodes = []
+        # codes are resolved in memory, all the unknown ones are reported at once
+        for position in positions:
+            if position.__class__ == Position:
+                if position.dimension != self.code:
+                    raise DimensionError(self, 'The position you want to add in status does not belong to the dimension')
+                code = position.code
+            elif position.__class__ in [str, unicode]:
+                code = position
+            elif position.__class__ == dict:
+                code = position['code']
+            else:
+                raise PositionError(position, 'Invalid object class')
+            ordinal = self._ordinals.get(code)
+            if ordinal is not None:
+                ordinals.append(ordinal)
+            else:
+                unknownCodes.append(code)
+        if unknownCodes and not silent:
+            raise PositionError(unknownCodes, 'Position codes do not exist: ' + ', '.join(unknownCodes))
+        return ordinals
+
+    def get_alpha_keys(self):
+        """
+        Return the alphabetical sort keys of the positions, as a dict of position
+        code: key. The keys are computed once per position and must not be modified.
+        """
+        keys = self._alphaKeys
+        if len(keys) != len(self.positions):
+            for code in self.positions:
+                if code not in keys:
+                    keys[code] = code.lower()
+        return keys
+
+    def unknown_positions(self, codes):
+        """
+        Return the codes of a list that are not positions of the dimension, in
+        the order of the list. Does not query the database.
+
+        Keywords arguments:
+        codes -- list of position codes to validate
+
+        """
+        positions = self.positions
+        return [code for code in codes if code not in positions]
 
     def _status_modify(self, positions, modification):
         """
@@ -394,52 +625,42 @@ class Dimension(object):
         
         Keywords arguments:
         positions -- list of postions of the dimension
-        modification -- [add|remove] the position list from the current status
+        modification -- [add|remove|keep] the position list from the current status
         
         """
-        tmpStatus = set(self.status)
-        for position in positions:
-            try:
-                if position.has_key('code'):
-                    {
-                        'add': lambda x: tmpStatus.add(Position(self.code, x['code'], x['description'])),
-                        'remove': lambda x: tmpStatus.remove(Position(self.code, x['code'], x['description']))
-                    }[modification](position)
+        # unknown positions are errors, except for keep which intersects the status with the list
+        bits = cubely.common.ordinals_to_bits(self._get_ordinals(positions, modification == 'keep'))
+        self._status_modify_bits(bits, modification)
 
-            # Exception generated by types without has_key function (str, unicode ...)
-            except AttributeError:
-                try:
-                    if position.__class__ == Position:
-                        {
-                            'add': lambda x: tmpStatus.add(x),
-                            'remove': lambda x: tmpStatus.remove(x)
-                        }[modification](position)
-                    elif position.__class__ in [str, unicode]:
-                        instance = self.positionCollection.find_one({'code': position})
-                        try:
-                            {
-                                'add': lambda x: tmpStatus.add(self.positions[x['code']]),
-                                'remove': lambda x: tmpStatus.remove(self.positions[x['code']])
-                            }[modification](instance)
-                        except TypeError:
-                            raise PositionError(position, 'Position code does not exist')
-                    else:
-                        raise PositionError(position, 'Invalid object class')
-                # Exception if we try to remove a position not in status
-                except KeyError:
-                    # check if another position with the same code is  already in status
-                    for pos in tmpStatus:
-                        if position.__class__ == Position:
-                            if pos.code == position.code:
-                                tmpStatus.remove(pos)
-                                break
-                        else:
-                            if pos.code == position:
-                                tmpStatus.remove(pos)
-                                break
-        self.status = list(tmpStatus)
-        self._check_positions_consistency()
-        
+    def _status_modify_bits(self, bits, modification):
+        """
+        Modify the status of the dimension with a bitset of positions. The
+        positions added are appended to the status list, the order of the
+        others is kept. Private.
+
+        Keywords arguments:
+        bits -- bitset of the position ordinals
+        modification -- [add|remove|keep] the positions from the current status
+
+        """
+        current = self._get_status_bits()
+        if modification == 'add':
+            newBits = current | bits
+        elif modification == 'remove':
+            newBits = current & ~bits
+        elif modification == 'keep':
+            newBits = current & bits
+        else:
+            raise ValueError
+        if self._statusList is not None and newBits != current:
+            if modification == 'add':
+                ordered = self._ordered
+                self._statusList = self._statusList + [ordered[o] for o in cubely.common.bits_to_ordinals(newBits & ~current)]
+            else:
+                removed = set(cubely.common.bits_to_ordinals(current & ~newBits))
+                ordinals = self._ordinals
+                self._statusList = [p for p in self._statusList if ordinals[p.code] not in removed]
+        self._statusBits = newBits
 
     def status_add(self, positions):
         """Add the positions in the list to the current status"""
@@ -451,25 +672,22 @@ class Dimension(object):
 
     def status_set(self, positions):
         """Set the current status to the positions list"""
-        self.status_clear()
-        self._status_modify(positions, 'add')
+        self._set_status(positions)
 
     def status_keep(self, positions):
         """Keep the positions in the list in status"""
-        if len(positions) == 0:
-            self.status_clear()
-        if positions[0].__class__ in [str, unicode]:
-            currentPos = [p.code for p in self.status]
-        elif positions[0].__class__ == Position:
-            currentPos = [p for p in self.status]
-        currentPos = set(currentPos)
-        posToSet = list(currentPos.intersection(set(positions)))
-        self.status_set(posToSet)
+        self._status_modify(positions, 'keep')
 
     def status_all(self):
         """Set the status to all positions"""
-        self.status = self.positions.values()
-        self._check_positions_consistency()
+        self._statusBits = self._get_all_bits()
+        self._pendingStatus = []
+        self._statusList = None
+
+    def status_complement(self):
+        """Set the status to the positions not currently in status"""
+        self._statusBits = self._get_all_bits() & ~self._get_status_bits()
+        self._statusList = None
 
     def get(self, code):
         """
@@ -479,17 +697,11 @@ class Dimension(object):
         code -- code of the position to return
 
         """
-        if code in self.positions.keys():
+        if code in self.positions:
             return self.positions[code]
         else:
             raise DimensionError(code, 'Unknown position code')
 
-    def _check_positions_consistency(self):
-        """Check that the positions in status belong to the dimension. Private."""
-        for p in self.status:
-            if p.dimension != self.code:
-                raise DimensionError(self, 'The position you want to add in status does not belong to the dimension')
-
 
 class Position(object):
     """
@@ -523,6 +735,11 @@ class Position(object):
         for cube in cubely.CUBES.values():
             #print cube
             if self.dimension in cube.dimensions:
+                cube._notify_change()
+                if cube.storage == 'chunked':
+                    # chunks hold the cells, only the cells of the position are written
+                    cube._values.delete_code(self.dimension, self.code, UPDATE_BATCH_SIZE)
+                    continue
                 cells = cube.cubeCollection.find({self.dimension: self.code}, snapshot=True)
                 for cell in cells:
                     cube.cubeCollection.remove(cell)
@@ -544,9 +761,28 @@ class Hierarchy(object):
     """Hold a hierarchy of position for one dimension. Singleton."""
     code = u''
     dimension = None
-    links = {}
+    # hierarchy indexed for sorting since its last change (see lang.check_hier)
+    indexed = False
+    # number of changes of the links, and number of changes when the ordering
+    # index was last written (None if it is not up to date in mongodb)
+    version = 0
+    indexedVersion = None
+    # ordering index, position code: index in the hierarchy order (None if not computed)
+    order = None
+    # links and childIndex are instance attributes only: the hierarchies opened
+    # lazily read them on first use (see __getattr__)
+    _lazy = False
+    _ancestors = {}
+    _descendants = {}
     hierCollection = None
 
+    def __getattr__(self, name):
+        # only called for the attributes not set yet
+        if self._lazy and name in ('links', 'childIndex'):
+            self._load_links()
+            return getattr(self, name)
+        raise AttributeError(name)
+
     def _setup_collection(self):
         """Create the mongodb collection to store the hierarchy"""
         colName = cubely.common.get_collection_name('hier', self.dimension, self.code)
@@ -562,9 +798,46 @@ class Hierarchy(object):
         """Clear the instance properties. Private."""
         self.code = u''
         self.dimension = None
+        self.indexed = False
+        self.version = 0
+        self.indexedVersion = None
+        self.order = None
+        self._lazy = False
         self.links = {}
+        self.childIndex = {}
+        self._ancestors = {}
+        self._descendants = {}
         self.hierCollection = None
 
+    def _index_link(self, code, parent):
+        """Record a link in the children index. Private."""
+        self._unindex_link(code)
+        self.childIndex.setdefault(parent, set()).add(code)
+        self._invalidate_closure(code, parent)
+
+    def _unindex_link(self, code):
+        """Remove the link of a position from the children index. Private."""
+        parent = self.links.get(code)
+        if parent is not None:
+            siblings = self.childIndex.get(parent)
+            if siblings is not None:
+                siblings.discard(code)
+                if not siblings:
+                    del self.childIndex[parent]
+            self._invalidate_closure(code, parent)
+
+    def _invalidate_closure(self, code, parent):
+        """
+        Drop the cached ancestors and descendants changed by linking a position
+        to a parent or unlinking it. Private.
+        """
+        self._descendants.pop(parent, None)
+        for ancestor in self.ancestors(parent):
+            self._descendants.pop(ancestor, None)
+        self._ancestors.pop(code, None)
+        for descendant in self.descendants(code):
+            self._ancestors.pop(descendant, None)
+
     def create(self, dim, code):
         """
         Create a new hierarchy
@@ -629,28 +902,96 @@ class Hierarchy(object):
             del hierSpecs['value'][hierIndex]
         cubely.db.metas.update({'code': 'hiers'}, hierSpecs)
         cubely.db.db.drop_collection(cubely.common.get_collection_name('hier', dimCode, code))
-        del cubely.HIERS[self.dimension][code]
+        del cubely.HIERS[dimCode][code]
 
-    def _get(self, dim, code):
+    def _get(self, dim, code, spec=None, lazy=False):
         """
-        Instanciate the position. Private.
+        Instanciate the hierarchy. Private.
 
         Keywords arguments:
         dim -- Dimension of the hierarchy.
-        code -- Code of the position
+        code -- Code of the hierarchy
+        spec -- meta entry of the hierarchy (default None, not indexed)
+        lazy -- read the links on first use only (default False)
 
         """
         self._clear()
         self.code = code
         self.dimension = dim
-        self.links = {}
+        if spec is not None:
+            self.indexed = spec.get('indexed', False)
+        if self.indexed:
+            # the ordering index stored is up to date
+            self.indexedVersion = self.version
         self._setup_collection()
-        colName = cubely.common.get_collection_name('hier', self.dimension, self.code)
-        if colName in cubely.db.get_collections():
-            links = cubely.db.db[colName].find()
-            for link in links:
-                self.links[link['code']] = link['parent']
-        return copy.copy(self)
+        if lazy:
+            del self.links, self.childIndex
+            self._lazy = True
+        else:
+            self._load_links()
+        hierCopy = copy.copy(self)
+        # the singleton must not load the links of the hierarchy
+        self._clear()
+        return hierCopy
+
+    def _load_links(self):
+        """Read the links of the hierarchy from mongodb. Private."""
+        self._lazy = False
+        self.links = {}
+        self.childIndex = {}
+        self._ancestors = {}
+        self._descendants = {}
+        for link in self.hierCollection.find():
+            self.links[link['code']] = link['parent']
+            self.childIndex.setdefault(link['parent'], set()).add(link['code'])
+
+    def _changed(self):
+        """Record a change of the links: the ordering index must be computed again. Private."""
+        self.version += 1
+        self.order = None
+        self.mark_indexed(False)
+
+    def compute_order(self):
+        """
+        Return the ordering index of the hierarchy, computed in memory: the top
+        positions first, then their children one level at a time. Return a dict
+        of position code: index.
+        """
+        parents = set(self.links.values())
+        level = list(parents.difference(self.links.keys()))
+        order = {}
+        while level:
+            for code in level:
+                order[code] = len(order)
+            level = [child for code in level for child in self.childIndex.get(code, ()) if child not in order]
+        return order
+
+    def get_order(self):
+        """
+        Return the ordering index of the hierarchy, as a dict of position code:
+        index (see compute_order). It is computed once until the links change
+        and must not be modified.
+        """
+        if self.order is None:
+            self.order = self.compute_order()
+        return self.order
+
+    def mark_indexed(self, indexed=True):
+        """
+        Record in the meta collection whether the hierarchy is indexed for
+        sorting. Only written when the flag changes.
+
+        Keywords arguments:
+        indexed -- True once lang.check_hier has indexed the hierarchy, False when a link changes (default True)
+
+        """
+        if indexed == self.indexed:
+            return
+        self.indexed = indexed
+        cubely.db.metas.update(
+            {'code': 'hiers', 'value': {'$elemMatch': {'code': self.code, 'dim': self.dimension}}},
+            {'$set': {'value.$.indexed': indexed}}
+        )
 
     def set(self, pos, parent):
         """
@@ -674,6 +1015,11 @@ class Hierarchy(object):
             parentCode = parent.code
         else:
             parentCode = parent
+        if self.links.get(posCode) == parentCode:
+            # nothing changes: the ordering index stays valid
+            return
+        if posCode == parentCode or posCode in self.ancestors(parentCode):
+            raise HierarchyError(posCode, 'Loop in the hierarchy')
         # Check if the document needs to be inserted or updated
         doc = {'code': posCode}
         docObj = self.hierCollection.find_one(doc)
@@ -683,7 +1029,92 @@ class Hierarchy(object):
         else:
             doc['parent'] = parentCode
             self.hierCollection.insert(doc)
+        self._index_link(posCode, parentCode)
         self.links[posCode] = parentCode
+        self._changed()
+
+    def set_many(self, links, skip_invalid=False, batchSize=None):
+        """
+        Set the parents of many positions at once. The links are all checked in
+        memory, whatever their order, then written in one bulk operation. Return
+        the list of the (code, parent) links skipped.
+
+        Keywords arguments:
+        links -- dict of parent codes by position code, or iterable of (code, parent) tuples
+        skip_invalid -- skip the links to unknown positions or making loops instead
+                        of raising, nothing is set otherwise (default False)
+        batchSize -- number of links sent to mongodb per bulk operation (default UPDATE_BATCH_SIZE)
+
+        """
+        if batchSize is None:
+            batchSize = UPDATE_BATCH_SIZE
+        if isinstance(links, dict):
+            links = links.iteritems()
+        positions = cubely.DIMS[self.dimension].positions
+        newLinks = {}
+        rejected = []
+        for pos, parent in links:
+            if pos.__class__ == cubely.core.Position:
+                pos = pos.code
+            if parent.__class__ == cubely.core.Position:
+                parent = parent.code
+            if pos not in positions or parent not in positions:
+                rejected.append((pos, parent))
+            elif self.links.get(pos) == parent:
+                # the links already set are not written again
+                newLinks.pop(pos, None)
+            else:
+                newLinks[pos] = parent
+        if rejected and not skip_invalid:
+            raise HierarchyError(rejected, 'Position does not exist')
+        # look for loops in the hierarchy with the new links
+        merged = dict(self.links)
+        merged.update(newLinks)
+        done = set()
+        for start in newLinks.keys():
+            path = []
+            onPath = set()
+            current = start
+            while current is not None and current not in done:
+                if current in onPath:
+                    loop = path[path.index(current):]
+                    if not skip_invalid:
+                        raise HierarchyError(current, 'Loop in the hierarchy')
+                    # the first new link of the loop is skipped, then the path is walked again
+                    code = [c for c in loop if c in newLinks][0]
+                    rejected.append((code, newLinks.pop(code)))
+                    if code in self.links:
+                        merged[code] = self.links[code]
+                    else:
+                        del merged[code]
+                    path = []
+                    onPath = set()
+                    current = start
+                    continue
+                path.append(current)
+                onPath.add(current)
+                current = merged.get(current)
+            done.update(path)
+        if not newLinks:
+            return rejected
+        def _operations():
+            for pos, parent in newLinks.iteritems():
+                yield {'code': pos}, {'$set': {'parent': parent}}
+        self._changed()
+        cubely.common.bulk_write(self.hierCollection, _operations(), batchSize)
+        for pos, parent in newLinks.iteritems():
+            oldParent = self.links.get(pos)
+            if oldParent is not None:
+                siblings = self.childIndex[oldParent]
+                siblings.discard(pos)
+                if not siblings:
+                    del self.childIndex[oldParent]
+            self.childIndex.setdefault(parent, set()).add(pos)
+            self.links[pos] = parent
+        # the closures are computed again when used
+        self._ancestors = {}
+        self._descendants = {}
+        return rejected
 
     def unset(self, code):
         """
@@ -693,9 +1124,11 @@ class Hierarchy(object):
         code -- Code of the position whose parent you want to unset
 
         """
-        if code in self.links.keys():
+        if code in self.links:
             self.hierCollection.remove({'code': code})
+            self._unindex_link(code)
             del self.links[code]
+            self._changed()
         else:
             raise HierarchyError(code, 'Cannot unset a member that has not been already set')
 
@@ -707,11 +1140,87 @@ class Hierarchy(object):
         code -- Code of the position
 
         """
-        if code in self.links.keys():
+        if code in self.links:
             return self.links[code]
         else:
             return False
 
+    def children(self, code):
+        """
+        Return the codes of the positions immediatly below a position in the
+        hierarchy.
+
+        Keywords arguments:
+        code -- Code of the position
+
+        """
+        return list(self.childIndex.get(code, ()))
+
+    def ancestors(self, code):
+        """
+        Return the codes of all the positions above a position in the hierarchy,
+        as a tuple starting with the parent: the distance of an ancestor is its
+        index + 1. The tuples are cached until a link above the position changes.
+
+        Keywords arguments:
+        code -- Code of the position
+
+        """
+        cache = self._ancestors
+        path = []
+        current = code
+        while current not in cache:
+            parent = self.links.get(current)
+            if parent is None:
+                cache[current] = ()
+                break
+            path.append(current)
+            if len(path) > len(self.links):
+                raise HierarchyError(code, 'Loop in the hierarchy')
+            current = parent
+        # fill the cache from the top of the walked path
+        for current in reversed(path):
+            parent = self.links[current]
+            cache[current] = (parent,) + cache[parent]
+        return cache[code]
+
+    def descendants(self, code):
+        """
+        Return all the positions below a position in the hierarchy, as a dict of
+        position code: distance (1 for the children). The dicts are cached until
+        a link below the position changes and must not be modified.
+
+        Keywords arguments:
+        code -- Code of the position
+
+        """
+        result = self._descendants.get(code)
+        if result is None:
+            result = {}
+            level = [code]
+            distance = 0
+            while level:
+                distance += 1
+                nextLevel = []
+                for current in level:
+                    for child in self.childIndex.get(current, ()):
+                        if child not in result and child != code:
+                            result[child] = distance
+                            nextLevel.append(child)
+                level = nextLevel
+            self._descendants[code] = result
+        return result
+
+    def depth(self, code):
+        """
+        Return the level of a position in the hierarchy, 0 for the top positions.
+
+        Keywords arguments:
+        code -- Code of the position
+
+        """
+        return len(self.ancestors(code))
+
 class Cube(object):
     """Object holding the data. Dimensioned by dimensions. Belong to a database. Singleton."""
     code = ''
@@ -719,11 +1228,13 @@ class Cube(object):
     dimensions = set()
     allowedTypes = ['string', 'int', 'float', 'boolean']
     type = ''
+    storage = 'dict'
     _values = {}
     collectionName = u''
     cubeCollection = None
     changedValues = set()
     aggregatedDims = set()
+    _savedMeta = None
 
     def _clear(self):
         """Clear the instance properties. Private."""
@@ -732,11 +1243,13 @@ class Cube(object):
         self.dimensions = set()
         self.allowedTypes = ['string', 'int', 'float', 'boolean']
         self.type = ''
+        self.storage = 'dict'
         self._values = {}
         self.collectionName = u''
         self.cubeCollection = None
         self.aggregatedDims = set()
         self.changedValues = set()
+        self._savedMeta = None
 
     def __add__(self, other):
         return self._standard_operators_multiple('add', other)
@@ -762,6 +1275,30 @@ class Cube(object):
     def __pow__(self, other):
         return self._standard_operators_multiple('pow', other)
 
+    def __radd__(self, other):
+        return self._standard_operators_reflected('add', other)
+
+    def __rsub__(self, other):
+        return self._standard_operators_reflected('sub', other)
+
+    def __rmul__(self, other):
+        return self._standard_operators_reflected('mul', other)
+
+    def __rtruediv__(self, other):
+        return self._standard_operators_reflected('div', other)
+
+    def __rdiv__(self, other):
+        return self._standard_operators_reflected('div', other)
+
+    def __rfloordiv__(self, other):
+        return self._standard_operators_reflected('fdv', other)
+
+    def __rmod__(self, other):
+        return self._standard_operators_reflected('mod', other)
+
+    def __rpow__(self, other):
+        return self._standard_operators_reflected('pow', other)
+
     def __abs__(self):
         return self._standard_operators_single(abs)
 
@@ -772,69 +1309,102 @@ class Cube(object):
     def __neg__(self):
         return self._standard_operators_single(neg)
 
+    def _new_result(self, dims, type=None):
+        """Return an empty in-memory cube to hold the result of an expression. Private."""
+        result = Cube()
+        result._clear()
+        result.code = u'TMP_EXPRESSION'
+        result.type = type or self.type or 'float'
+        result.dimensions = set(dims)
+        return result
+
     def _standard_operators_single(self, operator):
         """Private function to handle the single operators"""
-        wk = copy.deepcopy(self)
-        queryList = cubely.common.get_status_nuplet(wk.dimensions)
-        for query in queryList:
-            tmpval = wk.get(query)
-            if type(tmpval) == NoneType:
-                pass
-            else:
-                wk.set(query, operator(tmpval))
-        return wk
+        result = self._new_result(self.dimensions)
+        for cell, cellVal in cubely.common.iter_status_cells(self):
+            if cellVal is not None:
+                result.set(cell, operator(cellVal))
+        return result
+
+    def _standard_operators_scalar(self, fn, other, resultType=None, reflected=False):
+        """Private function computing the stored cells in status with a scalar"""
+        result = self._new_result(self.dimensions, resultType)
+        for cell, cellVal in cubely.common.iter_status_cells(self):
+            if cellVal is not None:
+                if reflected:
+                    result.set(cell, fn(other, cellVal))
+                else:
+                    result.set(cell, fn(cellVal, other))
+        return result
+
+    def _standard_operators_reflected(self, operator, other):
+        """Private function to handle multiple operators with a scalar on the left"""
+        fn, cells = CUBE_OPERATORS[operator]
+        if type(other) not in [IntType, LongType, FloatType]:
+            return NotImplemented
+        resultType = None
+        if operator == 'div':
+            resultType = 'float'
+        return self._standard_operators_scalar(fn, other, resultType, True)
 
-    """
-    @TODO : gérer le cas où other a des dimensions qui ne sont pas dans self.dimensions
-    """
     def _standard_operators_multiple(self, operator, other):
-        """Private function to handle multiple operators"""
-        wk = copy.deepcopy(self)
-        if other.__class__ == cubely.core.Cube:
-            wk.dimensions = wk.dimensions.union(other.dimensions)
-            queryList = cubely.common.get_status_nuplet(wk.dimensions)
-            for query in queryList:
-                querySelf = {}
-                queryOther = {}
-                for dim in query.keys():
-                    if dim in wk.dimensions:
-                        querySelf[dim] = query[dim]
-                    if dim in other.dimensions:
-                        queryOther[dim] = query[dim]
-                cellSelf = wk.get(querySelf)
-                cellOther = other.get(queryOther)
-                if type(cellSelf) == NoneType: cellSelf = 0
-                if type(cellOther) == NoneType: cellOther = 0
-                cellVal = {
-                    'add': cellSelf + cellOther,
-                    'sub': cellSelf - cellOther,
-                    'mul': cellSelf * cellOther,
-                    'div': truediv(cellSelf, cellOther),
-                    'fdv': cellSelf // cellOther,
-                    'mod': cellSelf % cellOther,
-                    'pow': pow(cellSelf, cellOther),
-                }[operator]
-                wk.set(querySelf, cellVal)
-                
-        elif type(other) is NoneType:
+        """
+        Private function to handle multiple operators. Only the stored cells in
+        status are computed: the union of the cells of both cubes for add and
+        sub (a missing cell counts as 0), their intersection for mul, div, fdv
+        and mod, the cells of self for pow. With a scalar, only the stored
+        cells of self are computed. The cells of a cube are repeated over the
+        status of the dimensions of the other cube it does not have.
+        """
+        fn, cells = CUBE_OPERATORS[operator]
+        # true divisions give floats whatever the type of the operands
+        resultType = None
+        if operator == 'div':
+            resultType = 'float'
+        if type(other) is NoneType:
             return None
         elif type(other) in [IntType, LongType, FloatType]:
-            queryList = cubely.common.get_status_nuplet(wk.dimensions)
-            for query in queryList:
-                cellVal = wk.get(query)
-                if type(cellVal) is NoneType:
-                    cellVal = 0
-                cellVal = {
-                    'add': cellVal + other,
-                    'sub': cellVal - other,
-                    'mul': cellVal * other,
-                    'div': truediv(cellVal, other),
-                    'fdv': cellVal // other,
-                    'mod': cellVal % other,
-                    'pow': pow(cellVal, other),
-                }[operator]
-                wk.set(query, cellVal)
-        return wk
+            return self._standard_operators_scalar(fn, other, resultType)
+        elif not isinstance(other, Cube):
+            raise CubeError(other, 'Invalid operand')
+
+        dims = list(self.dimensions.union(other.dimensions))
+        result = self._new_result(dims, resultType)
+        restrict = cubely.common.get_status_restrict(dims)
+
+        def read(cube):
+            """Return the stored values in status of an operand cube, by position tuple, and its dims"""
+            cubeDims = list(cube.dimensions)
+            values = {}
+            for cell, cellVal in cube.stored_cells(dict([(d, restrict[d]) for d in cubeDims])):
+                if cellVal is not None:
+                    values[tuple([cell[d] for d in cubeDims])] = cellVal
+            return values, cubeDims
+
+        def expand(values, cubeDims):
+            """Yield the cells of an operand repeated over the status of the dims it does not have"""
+            extraDims = [d for d in dims if d not in cubeDims]
+            extraTuples = list(cubely.common.product(*[restrict[d] for d in extraDims]))
+            for key, cellVal in values.iteritems():
+                for extra in extraTuples:
+                    cell = dict(zip(cubeDims, key))
+                    cell.update(zip(extraDims, extra))
+                    yield cell, cellVal
+
+        selfValues, selfDims = read(self)
+        otherValues, otherDims = read(other)
+        for cell, selfVal in expand(selfValues, selfDims):
+            otherVal = otherValues.get(tuple([cell[d] for d in otherDims]))
+            if otherVal is None:
+                if cells == 'intersection':
+                    continue
+                otherVal = 0
+            result.set(cell, fn(selfVal, otherVal))
+        if cells == 'union':
+            for cell, otherVal in expand(otherValues, otherDims):
+                if tuple([cell[d] for d in selfDims]) not in selfValues:
+                    result.set(cell, fn(0, otherVal))
+        return result
 
     def __deepcopy__(self, memo):
         newone = type(self)()
@@ -847,6 +1417,7 @@ class Cube(object):
         newone.description = u''
         newone.dimensions = copy.deepcopy(self.dimensions)
         newone.type = self.type
+        newone.storage = self.storage
         return newone
 
     def __str__(self):
@@ -856,13 +1427,30 @@ class Cube(object):
         buffer = buffer[:-1] + '> ' + self.description
         return buffer
 
-    def create(self, dims, type, code, desc):
+    def create(self, dims, type, code, desc, storage='dict'):
+        """
+        Create a new cube. Return the cube object.
+
+        Keywords arguments:
+        dims -- list of the dimensions (objects or codes) of the cube
+        type -- type of the values (string, int, float, boolean)
+        code -- Code of the cube. Must be unique in a given database.
+        desc -- Description of the cube
+        storage -- storage of the cells: dict, dense for a typed array of
+                   int/float/boolean values, or chunked for sparse typed chunks
+                   persisted as binary blobs (default dict)
+
+        """
         self._clear()
         code = code.upper()
         if type in self.allowedTypes:
             self.type = type
         else:
             raise CubeError(type, 'Invalid cube type')
+        if storage in cubely.storage.STORAGES:
+            self.storage = storage
+        else:
+            raise CubeError(storage, 'Invalid cube storage')
         if code in cubely.CUBES.keys():
             raise CubeError(code, 'Cube code already exists')
         for dim in dims:
@@ -874,6 +1462,7 @@ class Cube(object):
         self.description = desc
         self.collectionName = cubely.common.get_collection_name('cube', False, self.code)
         self.cubeCollection = cubely.db.db[self.collectionName]
+        self._values = self._new_store()
         cubely.DIMS_IN_USE.update(self.dimensions)
         cubeSpecs = cubely.db.metas.find_one({'code': 'cubes'})
         flagExist = False
@@ -883,11 +1472,12 @@ class Cube(object):
                     flagExist = True
                     break
             if not flagExist:
-                cubely.db.metas.update({'code': 'cubes'}, {'$push': {'value': {'code': self.code, 'desc': self.description, 'type': self.type, 'dims': list(self.dimensions), 'aggregated_dims':list(self.aggregatedDims)}}})
+                cubely.db.metas.update({'code': 'cubes'}, {'$push': {'value': {'code': self.code, 'desc': self.description, 'type': self.type, 'dims': list(self.dimensions), 'aggregated_dims':list(self.aggregatedDims), 'storage': self.storage}}})
 #                cubely.db.metas.update({'code': 'cubes'}, {'$push': {'value': {'code': self.code, 'desc': self.description, 'type': self.type, 'dims': list(self.dimensions)}}})
         else:
-            cubely.db.metas.insert({'code': 'cubes', 'value': [{'code': self.code, 'desc': self.description, 'type': self.type, 'dims': list(self.dimensions), 'aggregated_dims':list(self.aggregatedDims)}]})
+            cubely.db.metas.insert({'code': 'cubes', 'value': [{'code': self.code, 'desc': self.description, 'type': self.type, 'dims': list(self.dimensions), 'aggregated_dims':list(self.aggregatedDims), 'storage': self.storage}]})
 #            cubely.db.metas.insert({'code': 'cubes', 'value': [{'code': self.code, 'desc': self.description, 'type': self.type, 'dims': list(self.dimensions)}]})
+        self._savedMeta = self._get_meta_state()
         cubely.CUBES[self.code] = copy.copy(self)
         tmpCode = 'cubely.V_' + self.code + ' = cubely.CUBES[\'' + self.code + '\']'
         exec(tmpCode)
@@ -895,14 +1485,14 @@ class Cube(object):
 
     def delete(self, code):
         code = code.upper()
-        cubely.db.db.drop_collection(self.collectionName)
+        cubely.db.db.drop_collection(cubely.common.get_collection_name('cube', False, code))
         cubely.common.delete_meta_simple('cubes', code)
         del cubely.CUBES[code]
         tmpCode = 'del cubely.V_' + code
         exec(tmpCode)
 
     def set(self, pos, val):
-        dimsTup = cubely.common.get_position_tuple(pos)
+        dimsTup = cubely.common.get_position_tuple(pos, self.dimensions)
         # Checking the value is of the correct type
         if {
             #'numeric': cubely.common.is_numeric(val),
@@ -915,6 +1505,7 @@ class Cube(object):
             self._values[dimsTup] = {'int': int(float(val)), 'float': float(val), 'boolean': bool(val), 'string': val}[self.type]
             # flaging the changed values
             self.changedValues.add(dimsTup)
+            self._notify_change(pos)
             cubely.MODIFIED_CUBES.add(self.code)
         else:
             raise TypeError
@@ -930,6 +1521,9 @@ class Cube(object):
         try:
             return self._values[tuple(dimsTup)]
         except KeyError:
+            if self.storage == 'chunked' or self.cubeCollection is None:
+                # chunked stores and in-memory cubes hold all the stored cells
+                return None
             # Check if the position is stored but not loaded in memory
             stored = self.cubeCollection.find_one(pos)
             if stored:
@@ -939,14 +1533,77 @@ class Cube(object):
                 # it really does not exist
                 return None
 
-    def update(self):
-        # ensure that the collection is created and indexed
-        self.cubeCollection.ensure_index(
-            [(dim, ASCENDING) for dim in self.dimensions],
-            dropDups=True,
-            unique=True,
-            background=True
-        )
+    def get_many(self, coordinates=None):
+        """
+        Return the values of many cells, reading the cells not loaded yet in one
+        query. Return a list of (position dict, value) tuples, in the order of
+        the coordinates.
+
+        Keywords arguments:
+        coordinates -- iterable of position dicts (default None, the cells in
+                       the status of the dimensions of the cube)
+
+        """
+        if coordinates is None:
+            coordinates = cubely.common.iter_status_nuplet(self.dimensions)
+        dims = list(self.dimensions)
+        cells = []
+        missing = []
+        for pos in coordinates:
+            for d in dims:
+                if not pos.has_key(d):
+                    raise CubeError(d, 'Invalid dimension for cube')
+                if not cubely.DIMS[d].has_position(pos[d]):
+                    raise PositionError(d, 'Position does not exist')
+            dimsTup = tuple([pos[d] for d in dims])
+            cells.append((pos, dimsTup))
+            if dimsTup not in self._values:
+                missing.append(dimsTup)
+        # chunked stores and in-memory cubes hold all the stored cells
+        if missing and self.storage != 'chunked' and self.cubeCollection is not None:
+            self._load_cells(dims, missing)
+        return [(pos, self._values.get(dimsTup)) for pos, dimsTup in cells]
+
+    def _load_cells(self, dims, dimsTuples):
+        """
+        Read stored cells from the collection into memory. The cells are
+        selected by the positions of each dim ($in) when they fill most of this
+        box, by an $or of the cells otherwise. Private.
+        """
+        wanted = set(dimsTuples)
+        dimCodes = [set() for d in dims]
+        for dimsTup in wanted:
+            for i in range(len(dims)):
+                dimCodes[i].add(dimsTup[i])
+        boxSize = 1
+        for codes in dimCodes:
+            boxSize *= len(codes)
+        if boxSize <= 2 * len(wanted):
+            queries = [dict([(dims[i], {'$in': list(dimCodes[i])}) for i in range(len(dims))])]
+        else:
+            wantedList = list(wanted)
+            queries = []
+            for batchStart in range(0, len(wantedList), GET_MANY_BATCH_SIZE):
+                batch = wantedList[batchStart:batchStart + GET_MANY_BATCH_SIZE]
+                queries.append({'$or': [dict(zip(dims, dimsTup)) for dimsTup in batch]})
+        for query in queries:
+            for stored in self.cubeCollection.find(query):
+                dimsTup = tuple([stored[d] for d in dims])
+                # the cells changed in memory are kept
+                if dimsTup in wanted and dimsTup not in self._values:
+                    self._values[dimsTup] = stored['value']
+
+    def update(self, batchSize=None):
+        """
+        Write back the changed cells and the metadata changes. Return the number
+        of cells written.
+
+        Keywords arguments:
+        batchSize -- number of cells sent per bulk operation (default UPDATE_BATCH_SIZE)
+
+        """
+        if not batchSize:
+            batchSize = UPDATE_BATCH_SIZE
         # write back values
         # we're using a copy of changedValues to allow // update
         lock = Lock()
@@ -954,45 +1611,156 @@ class Cube(object):
         immutableChangedValues = self.changedValues
         self.changedValues = set()
         lock.release()
-        for coordTuples in immutableChangedValues:
-            doc = {}
-            dimIndex = 0
-            for d in self.dimensions:
-                doc[d] = coordTuples[dimIndex]
-                dimIndex += 1
-            # Check if the document needs to be inserted or updated
-            self.cubeCollection.update(doc, {"$set": {"value": self._values[coordTuples]}}, upsert=True)
+        startTime = time.time()
+        if self.storage == 'chunked':
+            # the changed cells are written back with their chunks
+            self._values.save(batchSize)
+            written = len(immutableChangedValues)
+        else:
+            # ensure that the collection is created and indexed
+            self.cubeCollection.ensure_index(
+                [(dim, ASCENDING) for dim in self.dimensions],
+                dropDups=True,
+                unique=True,
+                background=True
+            )
+            dims = list(self.dimensions)
+            def _operations():
+                for coordTuples in immutableChangedValues:
+                    doc = dict(zip(dims, coordTuples))
+                    yield doc, {"$set": {"value": self._values[coordTuples]}}
+            written = cubely.common.bulk_write(self.cubeCollection, _operations(), batchSize)
+        if written > 0:
+            elapsed = max(time.time() - startTime, 0.001)
+            cubely.common.cube_log('[' + self.code + '] ' + str(written) + ' cells written (' + str(int(written / elapsed)) + ' cells/s)', 3)
         # write back metadata changes
-        cubeSpecs = cubely.db.metas.find_one({'code': 'cubes'})['value']
-        cubeSpecIndex = None
-        for cubeSpec in cubeSpecs:
-            if cubeSpec['code'] == self.code:
-                cubeSpec['desc'] = self.description
-                cubeSpec['aggregated_dims'] = list(self.aggregatedDims)
-                cubeSpecIndex = cubeSpecs.index(cubeSpec)
-                cubeSpecs[cubeSpecIndex] = cubeSpec
-                break
-        cubely.db.metas.update({'code': 'cubes'}, {'$set': {'value': cubeSpecs}})
+        self._update_meta()
+        return written
+
+    def _get_meta_state(self):
+        """Return the part of the cube metadata that update() writes back. Private."""
+        return (self.description, sorted(self.aggregatedDims))
+
+    def _update_meta(self):
+        """Write back the cube metadata, only if it changed since it was last saved. Private."""
+        metaState = self._get_meta_state()
+        if metaState == self._savedMeta:
+            return
+        # aggregated dims are only ever added: $addToSet keeps the dims declared
+        # concurrently by other processes
+        cubely.db.metas.update(
+            {'code': 'cubes', 'value.code': self.code},
+            {
+                '$set': {'value.$.desc': self.description},
+                '$addToSet': {'value.$.aggregated_dims': {'$each': list(self.aggregatedDims)}}
+            }
+        )
+        self._savedMeta = metaState
 
     def rollback(self):
+        """Drop the changes not written back yet, the cells are read again from the database"""
+        changedValues = self.changedValues
         self.changedValues = set()
+        if self.storage == 'chunked':
+            # the chunks are loaded again when used
+            self._values = self._new_store()
+            self._notify_change()
+            return
+        dims = list(self.dimensions)
+        for dimsTup in changedValues:
+            if dimsTup in self._values:
+                del self._values[dimsTup]
+            self._notify_change(dict(zip(dims, dimsTup)))
+
+    def _notify_change(self, pos=None):
+        """
+        Invalidate the cached cells of the formulas reading the cube. Private.
 
-    def _get(self, code):
+        Keywords arguments:
+        pos -- position dict of the changed cell (default None, all the cells)
+
+        """
+        formulaCodes = cubely.FORMULA_DEPENDENCIES.get(self.code)
+        if not formulaCodes:
+            return
+        cell = None
+        if pos is not None:
+            cell = cubely.common.get_position_tuple(pos, sorted(self.dimensions))
+        for code in formulaCodes:
+            if code in cubely.FORMULAS:
+                cubely.FORMULAS[code].invalidate(self.code, cell)
+
+    def _get(self, code, spec=None):
         self._clear()
         self.code = code
         self.collectionName = cubely.common.get_collection_name('cube', self.code)
         self.cubeCollection = cubely.db.db[self.collectionName]
-        cubes = cubely.db.metas.find_one({'code': 'cubes'})['value']
+        if spec is None:
+            cubes = cubely.db.metas.find_one({'code': 'cubes'})['value']
+        else:
+            cubes = [spec]
         for cube in cubes:
             if cube['code'] == code:
                 self.description = cube['desc']
                 self.dimensions = set(cube['dims'])
                 self.type = cube['type']
                 self.aggregatedDims = set(cube['aggregated_dims'])
+                self.storage = cube.get('storage', 'dict')
                 break
-        self._values = {}
+        self._values = self._new_store()
+        self._savedMeta = self._get_meta_state()
         return copy.copy(self)
 
+    def _new_store(self):
+        """Return an empty cells store for the storage mode of the cube. Private."""
+        return cubely.storage.get_store(self.storage, list(self.dimensions), self.type, self.cubeCollection)
+
+    def stored_cells(self, restrict=None):
+        """
+        Iterate over the stored cells of the cube, including the changes not
+        written back yet. Yield (position dict, value) tuples.
+
+        Keywords arguments:
+        restrict -- dict of position codes lists by dimension code, limiting the
+                    cells to those positions (default None, all the cells)
+
+        """
+        if not restrict:
+            restrict = {}
+        dims = list(self.dimensions)
+        if self.storage == 'chunked':
+            restrictList = [restrict.get(d) for d in dims]
+            for key, value in self._values.iteritems(restrictList):
+                yield dict(zip(dims, key)), value
+            return
+        restrictSets = dict([(d, set(restrict[d])) for d in restrict.keys()])
+        if self.cubeCollection is None:
+            # in-memory cube, the result of an expression
+            for dimsTup, value in self._values.items():
+                cell = dict(zip(dims, dimsTup))
+                if [d for d in restrictSets.keys() if cell[d] not in restrictSets[d]]:
+                    continue
+                yield cell, value
+            return
+        query = {}
+        for dimCode in restrict.keys():
+            query[dimCode] = {'$in': list(restrict[dimCode])}
+        pending = set(self.changedValues)
+        for cell in self.cubeCollection.find(query):
+            del(cell['_id'])
+            value = cell['value']
+            del(cell['value'])
+            dimsTup = tuple([cell[d] for d in dims])
+            if dimsTup in pending:
+                value = self._values[dimsTup]
+                pending.discard(dimsTup)
+            yield cell, value
+        for dimsTup in pending:
+            cell = dict(zip(dims, dimsTup))
+            if [d for d in restrictSets.keys() if cell[d] not in restrictSets[d]]:
+                continue
+            yield cell, self._values[dimsTup]
+
     def declare_aggregated_dim(self, dim):
         dimObj = cubely.common.get_dim_object(dim)
         self.aggregatedDims.add(dimObj.code)
@@ -1046,29 +1814,64 @@ class Relation(object):
 
 class Formula(Cube):
     formula = u''
+    materialized = False
     _storage_cube = None
+    _expression = None
+    _cacheIndex = {}
+    _projections = None
+    _dirtyCells = set()
+    _stale = False
+    _dimensions = None
+
+    def _get_dimensions(self):
+        """Return the dimensions of the formula, compiling it on first use. Private."""
+        if self._dimensions is None:
+            self._dimensions = self._get_expression().dimensions()
+            self._register()
+        return self._dimensions
+
+    def _set_dimensions(self, dims):
+        self._dimensions = dims
+
+    dimensions = property(_get_dimensions, _set_dimensions)
 
     def _clear(self):
         self.formula = u''
+        self.materialized = False
         self._storage_cube = None
+        self._expression = None
+        self._dirtyCells = set()
+        self._stale = False
         Cube._clear(self)
-
-    def _get(self, code):
+        # cached cells, the least recently used first
+        self._values = OrderedDict()
+        self._cacheIndex = {}
+        self._projections = None
+
+    def _get_expression(self):
+        """Return the formula compiled into an expression tree, compiling it once. Private."""
+        if self._expression is None:
+            self._expression = cubely.expression.compile_formula(self.formula)
+        return self._expression
+
+    def _get(self, code, spec=None):
         self._clear()
         self.code = code.upper()
-        formulas = cubely.db.metas.find_one({'code': 'formulas'})['value']
+        if spec is None:
+            formulas = cubely.db.metas.find_one({'code': 'formulas'})['value']
+        else:
+            formulas = [spec]
         for formula in formulas:
             if formula['code'] == self.code:
                 self.description = formula['desc']
                 self.formula = formula['formula']
+                self.materialized = formula.get('materialized', False)
                 break
-        """
-        This exec does not generaly yeld data (the status is generally null
-        when its executed).
-        It's about getting the right dims for the formula.
-        """
-        exec('self._storage_cube = ' + self.formula)
-        self.dimensions = self._storage_cube.dimensions
+        # the formula is compiled on first use
+        self._dimensions = None
+        if self.materialized:
+            # the cells are read from the store when used
+            self._storage_cube = self._new_storage_cube()
         return copy.copy(self)
 
     def __str__(self):
@@ -1077,7 +1880,18 @@ class Formula(Cube):
         buffer = buffer[:-1] + '> ' + self.description
         return buffer
 
-    def create(self, code, taintedFormula, desc = None):
+    def create(self, code, taintedFormula, desc = None, materialized=False):
+        """
+        Create a new formula. Return the formula object.
+
+        Keywords arguments:
+        code -- Code of the formula. Must be unique in a given database.
+        taintedFormula -- formula, cubes and formulas are written @V_<code> and @F_<code>
+        desc -- Description of the formula (default None)
+        materialized -- compute all the cells once and store them in a collection,
+                        refreshed when the cubes read change (default False)
+
+        """
         self._clear()
         if code in cubely.FORMULAS.keys():
             raise CubeError(code, 'Cube code already exists')
@@ -1096,33 +1910,248 @@ class Formula(Cube):
                 cubely.db.metas.update({'code': 'formulas'}, {'$push': {'value': {'code': self.code, 'desc': self.description, 'formula': self.formula}}})
         else:
             cubely.db.metas.insert({'code': 'formulas', 'value': [{'code': self.code, 'desc': self.description, 'formula': self.formula}]})
+        self.dimensions = self._get_expression().dimensions()
+        self._register()
         cubely.FORMULAS[self.code] = copy.copy(self)
         tmpCode = 'cubely.F_' + self.code + ' = cubely.FORMULAS[\'' + self.code + '\']'
         exec(tmpCode)
+        if materialized:
+            cubely.FORMULAS[self.code].materialize()
         return cubely.FORMULAS[self.code]
 
-    def get(self, pos):
-        for dim in pos.keys():
+    def _new_storage_cube(self):
+        """Return the cube holding the cells of a materialized formula. Private."""
+        # typed like the result of the operators of the formula
+        storage = self._new_result(self.dimensions, self._get_expression().value_type())
+        # not the code of a cube: the formulas reading a cube of the same code are not notified
+        storage.code = u'F_' + self.code
+        storage.collectionName = cubely.common.get_collection_name('formula', False, self.code)
+        storage.cubeCollection = cubely.db.db[storage.collectionName]
+        storage._values = storage._new_store()
+        storage._savedMeta = storage._get_meta_state()
+        return storage
+
+    def materialize(self):
+        """
+        Compute all the cells of the formula and store them in a collection. The
+        stored cells are refreshed when the cubes read by the formula change, and
+        written back by update().
+        """
+        if not self.materialized:
+            self.materialized = True
+            cubely.db.metas.update(
+                {'code': 'formulas', 'value.code': self.code},
+                {'$set': {'value.$.materialized': True}}
+            )
+        self._build_storage()
+
+    def _build_storage(self):
+        """Compute and store all the cells of a materialized formula. Private."""
+        cubely.db.db.drop_collection(cubely.common.get_collection_name('formula', False, self.code))
+        self._storage_cube = self._new_storage_cube()
+        self._dirtyCells = set()
+        self._stale = False
+        # the cells are computed with all the positions in status
+        dims = list(self.dimensions)
+        for dim in dims:
             cubely.lang.push(dim)
-            cubely.lang.lmt(cubely.DIMS[dim], cubely.lang.to, pos[dim])
-        dimsTup = cubely.common.get_position_tuple(pos)
+            cubely.DIMS[dim].status_all()
         try:
-            cellVal = self._values[dimsTup]
-        except KeyError:
-            exec('self._storage_cube = ' + self.formula)
-            cellVal = self._storage_cube.get(pos)
-            self._values[dimsTup] = cellVal
+            result = self._get_expression().evaluate()
         finally:
-            for dim in pos.keys():
+            for dim in dims:
                 cubely.lang.pop(dim)
+        if isinstance(result, Cube):
+            for cell, cellVal in result.stored_cells():
+                self._storage_cube.set(cell, cellVal)
+        self._storage_cube.update()
+
+    def refresh(self):
+        """Compute again the stored cells of a materialized formula read from the cubes changed"""
+        if self._stale:
+            # positions were deleted, or a whole cube changed
+            self._build_storage()
+            return
+        dims = list(self.dimensions)
+        storage = self._storage_cube
+        # the cells of the formula read from the changed cells, each computed once
+        affected = set()
+        for cubeCode, cubeCell in self._dirtyCells:
+            # the dims of the formula not in the cube take all their positions
+            cubeDims = sorted(cubely.CUBES[cubeCode].dimensions)
+            dimValues = []
+            for dim in dims:
+                if dim in cubeDims:
+                    dimValues.append([cubeCell[cubeDims.index(dim)]])
+                else:
+                    dimValues.append(cubely.DIMS[dim].positions.keys())
+            try:
+                # Python 2.6+ version
+                dimsTuples = itertools.product(*dimValues)
+            except AttributeError:
+                # Python 2.5 version
+                dimsTuples = cubely.common.product(*dimValues)
+            affected.update(dimsTuples)
+        positions = [dict(zip(dims, dimsTup)) for dimsTup in affected]
+        # the cells are computed and the stored cells read in bulk
+        values = self._get_expression().get_many(positions)
+        for (pos, storedVal), cellVal in zip(storage.get_many(positions), values):
+            if cellVal is not None:
+                storage.set(pos, cellVal)
+            elif storedVal is not None:
+                # the cell is emptied, and deleted by update(). Keyed in the order of the store dims
+                storageTup = cubely.common.get_position_tuple(pos, storage.dimensions)
+                storage._values[storageTup] = None
+                storage.changedValues.add(storageTup)
+        self._dirtyCells = set()
+
+    def _register(self):
+        """Record the cubes read by the formula, whose changes invalidate its cached cells. Private."""
+        for cubeCode in self._get_expression().cubes():
+            cubely.FORMULA_DEPENDENCIES.setdefault(cubeCode, set()).add(self.code)
+
+    def _get_projections(self):
+        """
+        Return the indexes in the cells tuples of the formula of the dims of each
+        cube read, in the sorted order of the cube dims. Private.
+        """
+        if self._projections is None:
+            dims = list(self.dimensions)
+            self._projections = {}
+            for cubeCode in self._get_expression().cubes():
+                cubeDims = sorted(cubely.CUBES[cubeCode].dimensions)
+                self._projections[cubeCode] = [dims.index(d) for d in cubeDims]
+        return self._projections
+
+    def _cache_cell(self, dimsTup, cellVal):
+        """Cache a computed cell, evicting the least recently used cell if the cache is full. Private."""
+        if len(self._values) >= FORMULA_CACHE_SIZE:
+            self._uncache_cell(iter(self._values).next())
+        self._values[dimsTup] = cellVal
+        for cubeCode, indexes in self._get_projections().iteritems():
+            cubeCell = tuple([dimsTup[i] for i in indexes])
+            self._cacheIndex.setdefault(cubeCode, {}).setdefault(cubeCell, set()).add(dimsTup)
+
+    def _uncache_cell(self, dimsTup):
+        """Drop a cached cell. Private."""
+        self._values.pop(dimsTup, None)
+        for cubeCode, indexes in self._get_projections().iteritems():
+            cubeCells = self._cacheIndex.get(cubeCode, {})
+            cubeCell = tuple([dimsTup[i] for i in indexes])
+            if cubeCell in cubeCells:
+                cubeCells[cubeCell].discard(dimsTup)
+                if not cubeCells[cubeCell]:
+                    del cubeCells[cubeCell]
+
+    def invalidate(self, cubeCode, cell=None):
+        """
+        Drop the cached cells computed from a cell of a cube read by the formula.
+
+        Keywords arguments:
+        cubeCode -- code of the changed cube
+        cell -- tuple of the position codes of the changed cell, in the sorted
+                order of the cube dims (default None, drop all the cells)
+
+        """
+        if self.materialized:
+            if cell is None:
+                self._stale = True
+            else:
+                self._dirtyCells.add((cubeCode, cell))
+        if cell is None:
+            self._values = OrderedDict()
+            self._cacheIndex = {}
+            return
+        for dimsTup in list(self._cacheIndex.get(cubeCode, {}).get(cell, ())):
+            self._uncache_cell(dimsTup)
+
+    def get(self, pos):
+        if self.materialized:
+            if self._stale or self._dirtyCells:
+                self.refresh()
+            return self._storage_cube.get(pos)
+        dimsTup = cubely.common.get_position_tuple(pos, self.dimensions)
+        try:
+            # most recently used cells last
+            cellVal = self._values.pop(dimsTup)
+            self._values[dimsTup] = cellVal
+        except KeyError:
+            cellVal = self._get_expression().get(pos)
+            self._cache_cell(dimsTup, cellVal)
         return cellVal
 
-    def update(self):
-        pass
+    def get_many(self, coordinates=None):
+        if coordinates is None:
+            coordinates = cubely.common.iter_status_nuplet(self.dimensions)
+        if self.materialized:
+            if self._stale or self._dirtyCells:
+                self.refresh()
+            return self._storage_cube.get_many(coordinates)
+        coordinates = list(coordinates)
+        cells = {}
+        missing = []
+        for pos in coordinates:
+            dimsTup = cubely.common.get_position_tuple(pos, self.dimensions)
+            if dimsTup in cells:
+                continue
+            if dimsTup in self._values:
+                cells[dimsTup] = self.get(pos)
+            else:
+                cells[dimsTup] = None
+                missing.append((dimsTup, pos))
+        # the cells not cached are computed together, reading each cube in one query
+        values = self._get_expression().get_many([pos for dimsTup, pos in missing])
+        for (dimsTup, pos), cellVal in zip(missing, values):
+            cells[dimsTup] = cellVal
+            self._cache_cell(dimsTup, cellVal)
+        return [(pos, cells[cubely.common.get_position_tuple(pos, self.dimensions)]) for pos in coordinates]
+
+    def stored_cells(self, restrict=None):
+        """
+        Iterate over the cells of the formula computed in the current status, or
+        over the stored cells of a materialized formula. Yield (position dict,
+        value) tuples.
+
+        Keywords arguments:
+        restrict -- dict of position codes lists by dimension code, limiting the
+                    cells to those positions (default None, all the cells)
+
+        """
+        if self.materialized:
+            if self._stale or self._dirtyCells:
+                self.refresh()
+            return self._storage_cube.stored_cells(restrict)
+        result = self._get_expression().evaluate()
+        if not isinstance(result, Cube):
+            # formula of numbers only, no cells
+            return iter([])
+        return result.stored_cells(restrict)
+
+    def update(self, batchSize=None):
+        """Write back the refreshed cells of a materialized formula. Return the number of cells written."""
+        if not self.materialized:
+            return 0
+        if self._stale or self._dirtyCells:
+            self.refresh()
+        storage = self._storage_cube
+        # the emptied cells are deleted instead of being written as None
+        emptied = [dimsTup for dimsTup in storage.changedValues if storage._values.get(dimsTup) is None]
+        dims = list(storage.dimensions)
+        for batchStart in range(0, len(emptied), GET_MANY_BATCH_SIZE):
+            batch = emptied[batchStart:batchStart + GET_MANY_BATCH_SIZE]
+            storage.cubeCollection.remove({'$or': [dict(zip(dims, dimsTup)) for dimsTup in batch]})
+        for dimsTup in emptied:
+            storage.changedValues.discard(dimsTup)
+            del storage._values[dimsTup]
+        return storage.update(batchSize) + len(emptied)
 
     def delete(self, code):
+        code = code.upper()
+        cubely.db.db.drop_collection(cubely.common.get_collection_name('formula', False, code))
         cubely.common.delete_meta_simple('formulas', code)
         del cubely.FORMULAS[code]
+        for formulaCodes in cubely.FORMULA_DEPENDENCIES.values():
+            formulaCodes.discard(code)
 
     def set(self, pos, val):
         raise CubeError(self.code, 'You cannot set value to a VirtualCube')
\ No newline at end of file
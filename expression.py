@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""Compiled formula expressions for cubely"""
+
+import re
+import operator
+
+import cubely
+import cubely.core
+from cubely.errors import FormulaError
+
+try:
+    # Python 2.6+
+    import ast
+except ImportError:
+    # Python 2.5: formulas are evaluated by eval, like before
+    ast = None
+
+# *** Module global vars
+if ast is not None:
+    BINARY_OPERATORS = {
+        ast.Add: 'add',
+        ast.Sub: 'sub',
+        ast.Mult: 'mul',
+        ast.Div: 'div',
+        ast.FloorDiv: 'fdv',
+        ast.Mod: 'mod',
+        ast.Pow: 'pow',
+    }
+    UNARY_OPERATORS = {
+        ast.USub: operator.neg,
+        ast.UAdd: operator.pos,
+    }
+
+
+# *** Expression nodes
+class Node(object):
+    """
+    Node of a compiled formula. Each kind of node can be evaluated for one
+    cell (get) or over the current status of the dimensions (evaluate), which
+    returns a cube or a scalar.
+    """
+    scalar = False
+
+    def get_many(self, positions):
+        """Return the values of a list of cells, in the order of the positions"""
+        return [self.get(pos) for pos in positions]
+
+    def references(self):
+        """Return the set of the names (V_... and F_...) of the objects read by the node"""
+        return set()
+
+    def dimensions(self):
+        """Return the set of the dimension codes of the result"""
+        dims = set()
+        for name in self.references():
+            dims.update(get_reference(name).dimensions)
+        return dims
+
+    def cubes(self):
+        """
+        Return the set of the codes of the cubes read by the node, directly or
+        through the formulas it reads
+        """
+        codes = set()
+        for name in self.references():
+            obj = get_reference(name)
+            if obj.__class__ == cubely.core.Formula:
+                codes.update(obj._get_expression().cubes())
+            else:
+                codes.add(obj.code)
+        return codes
+
+    def value_type(self):
+        """
+        Return the cube type of the values of the node, given like the cube
+        operators: 'float' for a true division, else the type of the cube
+        operand. Nodes that can't be analysed give 'float'.
+        """
+        return 'float'
+
+
+class Constant(Node):
+    """Number in a formula"""
+    scalar = True
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self, pos):
+        return self.value
+
+    def get_many(self, positions):
+        return [self.value] * len(positions)
+
+    def evaluate(self):
+        return self.value
+
+    def value_type(self):
+        if isinstance(self.value, (int, long)):
+            return 'int'
+        return 'float'
+
+
+class Reference(Node):
+    """Cube or formula read by a formula, resolved by name when evaluated"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def get(self, pos):
+        obj = get_reference(self.name)
+        return obj.get(dict([(d, pos[d]) for d in obj.dimensions]))
+
+    def get_many(self, positions):
+        # the cells not loaded yet are read in one query
+        obj = get_reference(self.name)
+        dims = list(obj.dimensions)
+        return [cellVal for cell, cellVal in obj.get_many([dict([(d, pos[d]) for d in dims]) for pos in positions])]
+
+    def evaluate(self):
+        return get_reference(self.name)
+
+    def references(self):
+        return set([self.name])
+
+    def value_type(self):
+        obj = get_reference(self.name)
+        if obj.__class__ == cubely.core.Formula:
+            return obj._get_expression().value_type()
+        return obj.type
+
+
+class BinaryOperation(Node):
+    """
+    Arithmetic between 2 nodes. Cells are combined like cubely.core.Cube
+    operators: see cubely.core.CUBE_OPERATORS.
+    """
+
+    def __init__(self, operator, left, right):
+        self.operator = operator
+        self.fn, self.cells = cubely.core.CUBE_OPERATORS[operator]
+        self.left = left
+        self.right = right
+        self.scalar = left.scalar and right.scalar
+
+    def get(self, pos):
+        return self._combine(self.left.get(pos), self.right.get(pos))
+
+    def get_many(self, positions):
+        return map(self._combine, self.left.get_many(positions), self.right.get_many(positions))
+
+    def _combine(self, left, right):
+        """Return the value of a cell from the values of both operands. Private."""
+        if left is None and right is None:
+            return None
+        if self.left.scalar or self.right.scalar or self.cells == 'intersection':
+            # only the stored cells of a cube are computed with a scalar
+            if left is None or right is None:
+                return None
+        elif self.cells == 'union':
+            if left is None:
+                left = 0
+            if right is None:
+                right = 0
+        elif left is None:
+            return None
+        elif right is None:
+            right = 0
+        return self.fn(left, right)
+
+    def evaluate(self):
+        return self.fn(self.left.evaluate(), self.right.evaluate())
+
+    def references(self):
+        return self.left.references().union(self.right.references())
+
+    def value_type(self):
+        if self.operator == 'div':
+            return 'float'
+        # a scalar on the left is a reflected operator of the cube on the right
+        if self.left.scalar and not self.right.scalar:
+            return self.right.value_type()
+        return self.left.value_type()
+
+
+class UnaryOperation(Node):
+    """Unary minus or plus of a node"""
+
+    def __init__(self, fn, operand):
+        self.fn = fn
+        self.operand = operand
+        self.scalar = operand.scalar
+
+    def get(self, pos):
+        return self._apply(self.operand.get(pos))
+
+    def get_many(self, positions):
+        return map(self._apply, self.operand.get_many(positions))
+
+    def _apply(self, value):
+        """Return the value of a cell from the value of the operand. Private."""
+        if value is None:
+            return None
+        return self.fn(value)
+
+    def evaluate(self):
+        return self.fn(self.operand.evaluate())
+
+    def references(self):
+        return self.operand.references()
+
+    def value_type(self):
+        return self.operand.value_type()
+
+
+class EvalExpression(Node):
+    """
+    Formula that could not be compiled, evaluated by eval over the current
+    status. A cell is computed by evaluating the formula with the status limited
+    to the cell.
+    """
+
+    def __init__(self, formula, names):
+        self.formula = formula
+        self.names = names
+
+    def get(self, pos):
+        for dim in pos.keys():
+            cubely.lang.push(dim)
+            cubely.lang.lmt(cubely.DIMS[dim], cubely.lang.to, pos[dim])
+        try:
+            result = self.evaluate()
+            if isinstance(result, cubely.core.Cube):
+                return result.get(dict([(d, pos[d]) for d in result.dimensions]))
+            return result
+        finally:
+            for dim in pos.keys():
+                cubely.lang.pop(dim)
+
+    def evaluate(self):
+        return eval(self.formula)
+
+    def references(self):
+        return set([name for name in self.names if hasattr(cubely, name)])
+
+
+# *** Functions
+def get_reference(name):
+    """
+    Return the cube or formula of a name used in formulas.
+
+    Keywords arguments:
+    name -- V_<cube code> or F_<formula code>
+
+    """
+    if name.startswith('V_') and name[2:] in cubely.CUBES:
+        return cubely.CUBES[name[2:]]
+    if name.startswith('F_') and name[2:] in cubely.FORMULAS:
+        return cubely.FORMULAS[name[2:]]
+    raise FormulaError(name, 'Unknown cube or formula')
+
+
+def _compile_node(node):
+    """Return the expression node of an ast node. Private."""
+    if isinstance(node, ast.Expression):
+        return _compile_node(node.body)
+    if isinstance(node, ast.Num):
+        return Constant(node.n)
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'cubely' \
+            and node.attr[:2] in ['V_', 'F_']:
+        return Reference(node.attr)
+    if isinstance(node, ast.BinOp) and node.op.__class__ in BINARY_OPERATORS:
+        return BinaryOperation(BINARY_OPERATORS[node.op.__class__], _compile_node(node.left), _compile_node(node.right))
+    if isinstance(node, ast.UnaryOp) and node.op.__class__ in UNARY_OPERATORS:
+        return UnaryOperation(UNARY_OPERATORS[node.op.__class__], _compile_node(node.operand))
+    raise FormulaError(node, 'Unsupported formula syntax')
+
+
+def compile_formula(formula):
+    """
+    Parse a formula once into an expression tree. The formulas using syntax
+    other than numbers, cubely.V_... / cubely.F_... references and arithmetic
+    operators are evaluated by eval instead. Return the root Node.
+
+    Keywords arguments:
+    formula -- formula text, like 'cubely.V_SALES * 2'
+
+    """
+    names = re.findall(r'\b[VF]_\w+', formula)
+    if ast is None:
+        return EvalExpression(formula, names)
+    try:
+        return _compile_node(ast.parse(formula.strip(), mode='eval'))
+    except (SyntaxError, FormulaError):
+        return EvalExpression(formula, names)
@@ -7,10 +7,23 @@ import copy
 import csv
 import cubely
 from cubely.common import cube_log
-from cubely.errors import PositionAlreadyExistsError
 
+import os
+import mmap
+import traceback
+from Queue import Empty
 from multiprocessing import cpu_count
-from threading import Thread
+from multiprocessing import Pool
+from multiprocessing import Process
+from multiprocessing import Queue as ProcessQueue
+
+from pymongo import Connection
+
+# *** Module global vars
+SLICES_PER_WORKER = 4   # slices of a cube queued per aggregation worker, for load balancing
+CHUNK_BYTES = 64 * 1024 * 1024  # files bigger than that are read by chunks in parallel loads
+PARSE_BATCH_LINES = 100000  # lines of a file read before their content is loaded
+AGGREGATE_POLL_SECONDS = 5  # delay between two checks of the aggregation workers while waiting for a slice
 
 
 class Build(object):
@@ -25,6 +38,7 @@ class Build(object):
     
     parallel_load = False
     parallel_degree = 0
+    pushdown_aggreg = False
 
     def __init__(self, dbCode, dbDesc = u'', buildParams = {}):
         self.db['code'] = dbCode
@@ -68,23 +82,29 @@ class Build(object):
                 cubely.io.fileread(path, ficCopy)
 
         def _parallel_read(fileList):
-            waitingProcesses = []
+            # parallel_degree processes read the queued files while this process
+            # loads their content: the only writer to the database
+            cube_log('Nb of files to read: '+str(len(fileList)), 1, False)
+            tasks = []
             for fic in fileList:
-                waitingProcesses.append(Thread(target=cubely.io.fileread, args=(fic['path'],copy.copy(fic))))
-            cube_log('Nb of files to read: '+str(len(waitingProcesses)), 1, False)
-
-            while len(waitingProcesses) > 0:
-                runningProcesses = []
-                while len(runningProcesses) < self.parallel_degree:
-                    try:
-                        p = waitingProcesses[0]
-                    except:
-                        break
-                    runningProcesses.append(p)
-                    p.start()
-                    del(waitingProcesses[0])
-                for p in runningProcesses:
-                    p.join()
+                nbChunks = max(1, os.path.getsize(fic['path']) // CHUNK_BYTES)
+                for start, stop in _split_file(fic['path'], nbChunks):
+                    tasks.append((fic['path'], fic, start, stop))
+            loader = _Loader()
+            pool = Pool(self.parallel_degree)
+            try:
+                # applied in the order of the files, like a sequential read: the
+                # positions of a file are known when the cells of the next are set
+                for batches in pool.imap(_parse_task, tasks):
+                    for content in batches:
+                        loader.apply(content)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+            loader.finish()
 
         cube_log('Starting Reading Files', 1)
         if self.parallel_load:
@@ -98,40 +118,13 @@ class Build(object):
 
         # * Aggregations
         if self.parallel_load:
-            waitingProcesses = {}
-
-            for cubeCode in self.aggregates.keys():
-                partialAggreg = False
-                if self.aggregates[cubeCode] != 'all':
-                    partialAggreg = self.aggregates[cubeCode]
-                waitingProcesses[cubeCode] = Thread(target=cubely.lang.aggregate, args=(cubely.CUBES[cubeCode],), kwargs={'parallel_aggreg': True, 'partial_aggreg': partialAggreg})
-
-            cube_log('Nb of cubes to aggregate: '+str(len(waitingProcesses)), 1, False)
-
-            while len(waitingProcesses) > 0:
-                runningProcesses = []
-                # While there are cubes to aggregate
-                while len(runningProcesses) < self.parallel_degree:
-                    # Launch new threads while you don't reach the targetProcessesCount limit
-                    try:
-                        p = waitingProcesses[waitingProcesses.keys()[0]]
-                    except:
-                        # Exception when there is no cube left in the queue
-                        break
-                    runningProcesses.append(p)
-                    #cube_log('Len waitingprocess: '+str(len(waitingProcesses)), 1, False)
-                    p.start()
-                    #cube_log('Spawned process for cube '+waitingProcesses.keys()[0], 1, False)
-                    del(waitingProcesses[waitingProcesses.keys()[0]])
-                for p in runningProcesses:
-                    # Wait for the running threads to complete before launching new ones
-                    p.join()
+            self._parallel_aggregate()
         else:
             for cubeCode in self.aggregates.keys():
                 partialAggreg = False
                 if self.aggregates[cubeCode] != 'all':
                     partialAggreg = self.aggregates[cubeCode]
-                cubely.lang.aggregate(cubely.CUBES[cubeCode], partialAggreg)
+                cubely.lang.aggregate(cubely.CUBES[cubeCode], partial_aggreg=partialAggreg, pushdown=self.pushdown_aggreg)
 
         # * Postload
         for runnableCode in self.postloads:
@@ -141,155 +134,514 @@ class Build(object):
         cubely.db.close()
         cube_log('Database close. All done.', 1, True)
 
-
-def _get_fixed_reader(fullFileName):
-    reader = open(fullFileName, 'r')
-    return reader
+    def _aggregation_phases(self, cube):
+        """
+        Return the (dimension code, hierarchy code) rollups needed to aggregate
+        a cube, in order. Private.
+        """
+        partialAggreg = False
+        if self.aggregates[cube.code] != 'all':
+            partialAggreg = self.aggregates[cube.code]
+        phases = []
+        for dimCode in cube.dimensions:
+            if partialAggreg and dimCode not in partialAggreg:
+                continue
+            for hierCode in cubely.HIERS.get(dimCode, {}).keys():
+                phases.append((dimCode, hierCode))
+        return phases
+
+    def _aggregation_slices(self, cube, dimCode):
+        """
+        Split the rollup of a cube along a dimension in independent slices over
+        another dimension of the cube. Return a list of restrict dicts. Private.
+        """
+        otherDims = [d for d in cube.dimensions if d != dimCode]
+        # chunked cubes are written back by whole chunks: slices would overwrite each other
+        if len(otherDims) == 0 or cube.storage == 'chunked':
+            return [None]
+        sliceDim = max(otherDims, key=lambda d: len(cubely.DIMS[d].positions))
+        codes = cubely.DIMS[sliceDim].positions.keys()
+        nbSlices = min(len(codes), self.parallel_degree * SLICES_PER_WORKER)
+        if nbSlices <= 1:
+            return [None]
+        return [{sliceDim: codes[i::nbSlices]} for i in range(nbSlices)]
+
+    def _parallel_aggregate(self):
+        """
+        Aggregate the cubes with parallel_degree worker processes. Each rollup
+        of a cube is split in slices queued to the workers. The cubes are
+        independent while the rollups of a cube run one after the other: as
+        soon as the last slice of a rollup is done, the slices of the next
+        rollup of that cube are queued, which keeps every worker busy.
+        The workers only stop when told to: while waiting for a slice, a worker
+        that is not alive anymore fails the load instead of blocking it.
+        """
+        phases = {}
+        for cubeCode in self.aggregates.keys():
+            phases[cubeCode] = self._aggregation_phases(cubely.CUBES[cubeCode])
+        cube_log('Nb of cubes to aggregate: '+str(len(phases)), 1, False)
+
+        tasks = ProcessQueue()
+        done = ProcessQueue()
+        pending = {}
+        workers = [Process(target=_aggregate_worker, args=(self.db['code'], tasks, done))
+                   for i in range(self.parallel_degree)]
+
+        def _submit_next_phase(cubeCode):
+            # Queue all the slices of the next rollup of the cube. Return False when the cube is done.
+            if len(phases[cubeCode]) == 0:
+                return False
+            dimCode, hierCode = phases[cubeCode].pop(0)
+            cube_log('['+cubeCode+'] Rolling up dimension ' + dimCode + ' over hierarchy ' + hierCode, 2)
+            slices = self._aggregation_slices(cubely.CUBES[cubeCode], dimCode)
+            pending[cubeCode] = len(slices)
+            for restrict in slices:
+                tasks.put((cubeCode, dimCode, hierCode, restrict, self.pushdown_aggreg))
+            return True
+
+        for worker in workers:
+            worker.start()
+        try:
+            running = 0
+            for cubeCode in phases.keys():
+                if _submit_next_phase(cubeCode):
+                    running += 1
+            while running > 0:
+                try:
+                    cubeCode, error = done.get(timeout=AGGREGATE_POLL_SECONDS)
+                except Empty:
+                    for worker in workers:
+                        if not worker.is_alive():
+                            cubeCodes = ', '.join([c for c in pending.keys() if pending[c] > 0])
+                            raise cubely.errors.CubeError(cubeCodes, 'Aggregation worker died with exit code ' + str(worker.exitcode))
+                    continue
+                if cubeCode is None:
+                    raise cubely.errors.CubeError(self.db['code'], 'Aggregation worker failed to open the database\n' + error)
+                if error:
+                    raise cubely.errors.CubeError(cubeCode, 'Aggregation failed\n' + error)
+                pending[cubeCode] -= 1
+                if pending[cubeCode] == 0 and not _submit_next_phase(cubeCode):
+                    cube_log('Done aggregating cube ' + cubeCode, 1, True)
+                    running -= 1
+            for worker in workers:
+                tasks.put(None)
+        except:
+            for worker in workers:
+                worker.terminate()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+
+        # The workers wrote the cells and metadata: drop what this process has in memory
+        for cubeCode in self.aggregates.keys():
+            cube = cubely.CUBES[cubeCode]
+            cube._values = cube._new_store()
+            cube._notify_change()
+            for dimCode, hierCode in self._aggregation_phases(cube):
+                cube.declare_aggregated_dim(dimCode)
+            cube.update()
+
+
+def _init_aggregate_worker(dbCode):
+    """Open the database in a new aggregation worker process. Private."""
+    # the connection inherited from the parent process cannot be shared
+    cubely.CONNECTION = Connection()
+    cubely.common.reset_global_vars()
+    cubely.db.open(dbCode)
+
+
+def _aggregate_worker(dbCode, tasks, done):
+    """
+    Roll up the slices queued in tasks until a None task, in an aggregation
+    worker process. The (cube code, error) of each slice is put in done, a
+    failure to open the database as a (None, error) tuple. Private.
+    """
+    try:
+        _init_aggregate_worker(dbCode)
+    except Exception:
+        done.put((None, traceback.format_exc()))
+        return
+    for task in iter(tasks.get, None):
+        done.put(_aggregate_slice(*task))
+
+
+def _aggregate_slice(cubeCode, dimCode, hierCode, restrict, pushdown):
+    """
+    Roll up a slice of a cube in an aggregation worker process.
+    Return a (cube code, error traceback or None) tuple. Private.
+    """
+    try:
+        cube = cubely.CUBES[cubeCode]
+        # cells cached by a previous task may be stale
+        cube._values = cube._new_store()
+        cube._notify_change()
+        dim = cubely.DIMS[dimCode]
+        hier = cubely.HIERS[dimCode][hierCode]
+        if pushdown and cube.storage != 'chunked':
+            cubely.lang.rollup_pushdown(cube, dim, hier, restrict)
+        else:
+            cubely.lang.rollup(cube, dim, hier, restrict)
+        return cubeCode, None
+    except Exception:
+        return cubeCode, traceback.format_exc()
 
 
-def _get_structured_reader(fullFileName, delimiter, quoteChar = None):
-    reader = csv.reader(open(fullFileName), delimiter=delimiter, quotechar=quoteChar)
-    return reader
+def _split_file(fullFileName, nbChunks):
+    """
+    Split a file in about nbChunks byte ranges starting at the beginning of a
+    line. Return a list of (start, stop) offsets.
 
+    Keywords arguments:
+    fullFileName -- path of the file to split
+    nbChunks -- number of ranges wanted
 
-def _get_field_value(type, line, index, field):
+    """
+    size = os.path.getsize(fullFileName)
+    bounds = [0]
+    fic = open(fullFileName, 'rb')
+    try:
+        for i in range(1, nbChunks):
+            offset = max(size * i // nbChunks, bounds[-1])
+            fic.seek(offset)
+            # move to the start of the next line
+            if offset > 0:
+                fic.seek(offset - 1)
+                fic.readline()
+            offset = fic.tell()
+            if offset >= size:
+                break
+            if offset > bounds[-1]:
+                bounds.append(offset)
+    finally:
+        fic.close()
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+def _iter_lines(fic, start=0, stop=None):
+    """Yield the lines of an open file between the start and stop offsets"""
+    fic.seek(start)
+    position = start
+    while stop is None or position < stop:
+        line = fic.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line
+
+
+def _iter_records(mm, start, stop):
+    """
+    Yield the (start, end) offsets of the lines of a mapped file between the
+    start and stop offsets, skipping the empty and '*' comment lines. The
+    lines themselves are not copied.
+    """
+    position = start
+    while position < stop:
+        end = mm.find('\n', position, stop)
+        if end < 0:
+            end = stop
+        if end > position and mm[position] != '*':
+            yield position, end
+        position = end + 1
+
+
+def _get_fixed_reader(fullFileName, start=0, stop=None):
+    fic = open(fullFileName, 'rb')
+    if os.fstat(fic.fileno()).st_size == 0:
+        # empty files can't be mapped
+        return fic, iter([])
+    try:
+        mm = mmap.mmap(fic.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fic.close()
+    if stop is None or stop > mm.size():
+        stop = mm.size()
+    return mm, _iter_records(mm, start, stop)
+
+
+def _get_structured_reader(fullFileName, delimiter, quoteChar = None, start=0, stop=None):
+    fic = open(fullFileName, 'rb')
+    # '*' comment lines are skipped before being split, as in fixed files
+    lines = (line for line in _iter_lines(fic, start, stop) if line[0] != '*')
+    reader = csv.reader(lines, delimiter=delimiter, quotechar=quoteChar)
+    return fic, reader
+
+
+# Kinds of the steps of a compiled file definition
+_POSITION_CODE = 0
+_POSITION_DESC = 1
+_PARENT = 2
+_CELL = 3
+
+
+def _get_extractor(type, index, field, source=None, decode=True):
+    """
+    Return a function extracting the value of a field from a line. The lines
+    of structured files are lists of fields, the lines of fixed files are
+    (start, end) offsets in the mapped file.
+
+    Keywords arguments:
+    type -- file type, 'structured' or 'fixed'
+    index -- index of the field in the file definition
+    field -- field definition
+    source -- mapped file, for fixed files
+    decode -- True to return unicode, False for the raw bytes (default True)
+
+    """
+    if 'expression' in field:
+        value = field['expression']
+        return lambda line: value
     if type == 'structured':
-        return line[index].strip().decode('utf-8')
+        if decode:
+            return lambda line: line[index].strip().decode('utf-8')
+        return lambda line: line[index].strip()
     elif type == 'fixed':
-        return line[field['start']-1:field['stop']-1].strip().decode('utf-8')
+        first = field['start'] - 1
+        last = field['stop'] - 1
+        # only the columns of the field are copied out of the mapped file
+        if decode:
+            return lambda line: source[line[0]+first:min(line[0]+last, line[1])].strip().decode('utf-8')
+        return lambda line: source[line[0]+first:min(line[0]+last, line[1])].strip()
     else:
         raise ValueError
 
-cubesToUpdate = set()
 
-def fileread(fullFileName, definition):
-    # Getting a file handle
-    if not definition.has_key('separator'):
-        definition['separator'] = '\t'
+def _compile_definition(definition, source=None):
+    """
+    Compile a file definition into the plan applied to each line of the file.
+    Return a (filters, steps) tuple:
+    filters -- (extractor, kept value) of each filter
+    steps -- (kind, extractor, object code, data nature, MATCH, APPEND) of each field, in the order of the fields
 
-    fic = {
-        'fixed': _get_fixed_reader(fullFileName),
-        'structured': _get_structured_reader(fullFileName, definition['separator'])
-    }[definition['type']]
+    Keywords arguments:
+    definition -- file definition (type, separator, filter and fields by index)
+    source -- mapped file, for fixed files
 
-    operationalDefinition = copy.copy(definition)
-    
-    filters = []
-
-    for defKey in operationalDefinition.keys():
-        if defKey in ['type', 'separator', 'path']:
-            del operationalDefinition[defKey]
+    """
+    type = definition['type']
+    if type not in ['structured', 'fixed']:
+        raise ValueError
+    fields = dict((k, v) for k, v in definition.items() if k not in ['type', 'separator', 'path', 'filter'])
 
-        if defKey == 'filter':
-            filters.append(operationalDefinition[defKey])
-            del operationalDefinition[defKey]
+    filters = []
+    if 'filter' in definition:
+        filter = definition['filter']
+        keep = filter['keep']
+        if isinstance(keep, unicode):
+            # filters compare raw bytes, the lines filtered out are never decoded
+            extract = _get_extractor(type, filter['field'], fields[filter['field']], source, decode=False)
+            keep = keep.encode('utf-8')
+        else:
+            extract = _get_extractor(type, filter['field'], fields[filter['field']], source)
+        filters.append((extract, keep))
+
+    steps = []
+    for fieldKey in sorted(fields.keys()):
+        field = fields[fieldKey]
+        dataNature = field.get('dataNature')
+        if field['objectType'] == 'Dimension' and dataNature == 'code':
+            kind = _POSITION_CODE
+        elif field['objectType'] == 'Dimension' and dataNature == 'desc':
+            kind = _POSITION_DESC
+        elif field['objectType'] == 'Hierarchy':
+            kind = _PARENT
+        elif field['objectType'] == 'Cube':
+            kind = _CELL
+        else:
+            continue
+        metas = field.get('metas', [])
+        steps.append((kind, _get_extractor(type, fieldKey, field, source), field['objectCode'], dataNature,
+                      'MATCH' in metas, 'APPEND' in metas))
+    return filters, steps
+
+
+def _parse_file(fullFileName, definition, start=0, stop=None):
+    """
+    Read a file, or the lines of a range of it, following its definition,
+    without modifying the database.
+    Yield the content to load by batches of at most PARSE_BATCH_LINES lines,
+    each batch a dict of lists:
+    positions -- (dim code, position code, position desc) of the APPEND positions
+    links -- (dim code, hier code, position code, parent code) of the hierarchies
+    cells -- (cube code, position dict, value) of the cubes
+
+    Keywords arguments:
+    fullFileName -- path of the file to read
+    definition -- file definition (type, separator, filter and fields by index)
+    start -- offset of the first line to read (default 0)
+    stop -- offset after the last line to read (default None, end of file)
+
+    """
+    if definition['type'] == 'fixed':
+        handle, fic = _get_fixed_reader(fullFileName, start, stop)
+        filters, steps = _compile_definition(definition, handle)
+    elif definition['type'] == 'structured':
+        handle, fic = _get_structured_reader(fullFileName, definition.get('separator', '\t'), start=start, stop=stop)
+        filters, steps = _compile_definition(definition)
+    else:
+        raise ValueError
 
-    mayBeParentPositions = []
-    checkHier = set()
+    positions = []
+    links = []
+    cells = []
+    nbLines = 0
 
     cube_log('Reading File: ' + fullFileName, 2)
     try:
         for line in fic:
-            circuitBreaker = False
-            if line[0] == '*':
+            nbLines += 1
+            if nbLines > PARSE_BATCH_LINES:
+                yield {'positions': positions, 'links': links, 'cells': cells}
+                positions = []
+                links = []
+                cells = []
+                nbLines = 1
+            if len(line) == 0:
                 continue
-            for filter in filters:
-                filterIndex = filter['field']
-                filterQuery = filter['keep']
-                if filterQuery != _get_field_value(
-                                    definition['type'],
-                                    line,
-                                    filterIndex,
-                                    operationalDefinition[filterIndex]):
-                    circuitBreaker = True
-            if circuitBreaker:
+            kept = True
+            for extract, keep in filters:
+                if extract(line) != keep:
+                    kept = False
+            if not kept:
                 continue
-            pendingPosition = {}
             currentPositionCode = u''
+            positionCodes = {}
+            positionDescs = {}
+            appendDims = []
+            parents = []
             cellToSet = {}
-            for fieldKey in operationalDefinition.keys():
-                field = operationalDefinition[fieldKey]
-
-                if field['objectType'] == 'Dimension':
-                    obj = cubely.DIMS[field['objectCode']]
-
-                if field['objectType'] == 'Hierarchy':
-                    obj = cubely.HIERS[field['dataNature']][field['objectCode']]
-                    checkHier.add(obj)
-
-                if field['objectType'] == 'Cube':
-                    obj = cubely.CUBES[field['objectCode']]
-                    # to delete ??
-                    #obj.code = field['objectCode']
-                    cubesToUpdate.add(obj.code)
-
-                if 'expression' in field.keys():
-                    field_value = field['expression']
-                else:
-                    field_value = _get_field_value(definition['type'], line, fieldKey, field)
-
+            for kind, extract, objectCode, dataNature, match, append in steps:
+                fieldValue = extract(line)
                 # Adding positions
-                # ** Position code
-                if field['objectType'] == 'Dimension' and field['dataNature'] == 'code':
-                    currentPositionCode = field_value
-                    if 'MATCH' in field['metas']:
-                        if obj.has_position(currentPositionCode):
-                            cellToSet[obj.code] = currentPositionCode
-                        else:
-                            print '** Invalid ' + obj.code + ' position code : ' + currentPositionCode
-                            continue
-
-                    if 'APPEND' in field['metas']:
-                        if not obj.has_position(currentPositionCode):
-                            if pendingPosition == {}:
-                                pendingPosition['code'] = currentPositionCode
-                            else:
-                                obj.add_position(currentPositionCode, pendingPosition['desc'])
-                # ** Position desc
-                if field['objectType'] == 'Dimension' and field['dataNature'] == 'desc':
-                    desc = field_value
-                    if pendingPosition == {}:
-                        pendingPosition['desc'] = desc
-                    else:
-                        try:
-                            obj.add_position(pendingPosition['code'], desc)
-                        except PositionAlreadyExistsError:
-                            pass
-
+                if kind == _POSITION_CODE:
+                    currentPositionCode = fieldValue
+                    positionCodes[objectCode] = fieldValue
+                    if match:
+                        cellToSet[objectCode] = currentPositionCode
+                    if append:
+                        appendDims.append(objectCode)
+                elif kind == _POSITION_DESC:
+                    positionDescs[objectCode] = fieldValue
                 # Parentage informations
-                if field['objectType'] == 'Hierarchy':
-                    parentCode = field_value
-                    if parentCode != u'':
-                        try:
-                            obj.set(currentPositionCode, parentCode)
-                        except cubely.errors.HierarchyError:
-                            mayBeParentPositions.append({'dim': obj.dimension, 'hier': obj.code, 'position':currentPositionCode, 'parent':parentCode})
-
+                elif kind == _PARENT:
+                    if fieldValue != u'':
+                        parents.append((dataNature, objectCode, fieldValue))
                 # Setting cube value
-                if field['objectType'] == 'Cube':
-                    cellVal = field_value
-                    obj.set(cellToSet, cellVal)
-
+                else:
+                    cells.append((objectCode, cellToSet, fieldValue))
+            # the code of a position may come after its desc or its parents
+            for dimCode in appendDims:
+                positions.append((dimCode, positionCodes[dimCode], positionDescs.get(dimCode)))
+            for dimCode, hierCode, parentCode in parents:
+                links.append((dimCode, hierCode, positionCodes.get(dimCode, currentPositionCode), parentCode))
+    finally:
+        handle.close()
+
+    yield {'positions': positions, 'links': links, 'cells': cells}
+
+
+def _parse_task(task):
+    """
+    Read a (path, definition, start, stop) range of a file in a reader worker
+    process. Return the list of its batches of content. Private.
+    """
+    fullFileName, definition, start, stop = task
+    return list(_parse_file(fullFileName, definition, start, stop))
+
+
+class _Loader(object):
+    """
+    Load the content read from files into the database. Whatever the number of
+    files or reader processes, all the modifications of dimensions, hierarchies
+    and cubes go through one loader, in one process.
+    """
+    cubesToUpdate = set()
+    hiersToCheck = set()
+    hierLinks = {}
+
+    def __init__(self):
+        self.cubesToUpdate = set()
+        self.hiersToCheck = set()
+        self.hierLinks = {}
+
+    def apply(self, content):
+        """Load a batch of content yielded by _parse_file"""
+        # Positions, inserted in batches by dimension
+        newPositions = {}
+        for dimCode, code, desc in content['positions']:
+            newPositions.setdefault(dimCode, []).append((code, desc))
+        for dimCode, positions in newPositions.iteritems():
+            cubely.DIMS[dimCode].add_positions(positions, skip_existing=True)
+
+        # Parentage informations, set once all the files are read: the parent
+        # may come later
+        for dimCode, hierCode, code, parentCode in content['links']:
+            hier = cubely.HIERS[dimCode][hierCode]
+            self.hiersToCheck.add(hier)
+            self.hierLinks.setdefault(hier, []).append((code, parentCode))
+
+        # Cube values
+        for cubeCode, cellToSet, cellVal in content['cells']:
+            invalidDims = [d for d in cellToSet.keys() if not cubely.DIMS[d].has_position(cellToSet[d])]
+            if invalidDims:
+                cube_log('['+cubeCode+'] Invalid ' + invalidDims[0] + ' position code : ' + cellToSet[invalidDims[0]] + ', cell skipped', 2)
+                continue
+            cubely.CUBES[cubeCode].set(cellToSet, cellVal)
+            self.cubesToUpdate.add(cubeCode)
 
-        # Check the maybe positions
-        if len(mayBeParentPositions) > 0:
-            for pos in mayBeParentPositions:
-                try:
-                    cubely.HIERS[pos['dim']][pos['hier']].set(pos['position'], pos['parent'])
-                except cubely.errors.HierarchyError:
-                    print '* Unknown parent position ' + pos['parent']
+    def finish(self):
+        """Set the links, save the cubes and index the hierarchies"""
+        # Links are written in bulk, by hierarchy
+        for hier, links in self.hierLinks.iteritems():
+            for code, parentCode in hier.set_many(links, skip_invalid=True):
+                cube_log('['+hier.code+'] Invalid parent position ' + parentCode + ' for ' + code + ', link skipped', 2)
+        self.hierLinks = {}
 
         # Saving cubes that have been updated
-        for cubeCode in cubesToUpdate:
+        for cubeCode in self.cubesToUpdate:
             cube_log('Updating cube ' + cubeCode, 2)
             cubely.CUBES[cubeCode].update()
+        self.cubesToUpdate = set()
 
         # Checking hiers
-        for hier in checkHier:
+        for hier in self.hiersToCheck:
             cubely.lang.check_hier(hier)
-    finally:
-        if definition['type'] == 'fixed':
-            fic.close()
-
-
-
+        self.hiersToCheck = set()
+
+
+def fileread(fullFileName, definition, parallel_degree=1):
+    """
+    Load a file into the database.
+
+    Keywords arguments:
+    fullFileName -- path of the file to read
+    definition -- file definition (type, separator, filter and fields by index)
+    parallel_degree -- number of processes reading ranges of the file at the
+                       same time (default 1, no parallelism)
+
+    """
+    loader = _Loader()
+    if parallel_degree > 1:
+        # the ranges are read in parallel, their content loaded by this process only.
+        # The content of a range is sent back at once: big files are split in more ranges
+        nbChunks = max(parallel_degree, os.path.getsize(fullFileName) // CHUNK_BYTES)
+        tasks = [(fullFileName, definition, start, stop) for start, stop in _split_file(fullFileName, nbChunks)]
+        pool = Pool(parallel_degree)
+        try:
+            # applied in the order of the ranges, like a sequential read
+            for batches in pool.imap(_parse_task, tasks):
+                for content in batches:
+                    loader.apply(content)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for content in _parse_file(fullFileName, definition):
+            loader.apply(content)
+    # all the cells of the file are written back at once
+    loader.finish()
@@ -7,7 +7,6 @@ import cubely.core
 import cubely
 from cubely.core import *
 from cubely.errors import *
-from cubely.common import find_keys
 from cubely.common import get_dim_object
 from cubely.common import get_hier_object
 from cubely.common import check_dim_is_in_cube
@@ -28,6 +27,8 @@ keep = 'keep'
 # *** Module global vars
 DIMS_TEMPORARY_STATUS = {}
 UPDATE_INTERVAL = 500000
+PUSHDOWN_BATCH_SIZE = 10000     # number of child positions shipped per aggregation pipeline
+PUSHDOWN_MIN_SERVER_VERSION = (4, 4)    # first mongodb version merging a pipeline into the collection it reads
 
 # *** Functions
 def all(dim, method, hierCode = None):
@@ -61,11 +62,9 @@ def _set_final_status_hier(dim, method, result, originalStatus):
     if method == to:
         dim.status_set([x for x in result])
     elif method == remove:
-        result = originalStatus.difference(result)
-        dim.status_set([x for x in result])
+        dim.status_remove([x for x in result])
     elif method == keep:
-        result = result.intersection(originalStatus)
-        dim.status_set([x for x in result])
+        dim.status_keep([x for x in result])
     elif method == add:
         dim.status_add([x for x in result])
 
@@ -84,26 +83,14 @@ def ancestors(dim, method, hierCode):
     """
     result = set()
     originalStatus = set(dim.status)
-    currentRoundResults = set('bogus_to_allow_first_iteration')
-    currentStatus = dim.status
     try:
         hier = cubely.HIERS[dim.code][hierCode]
     except:
         raise HierarchyError(hierCode, 'Hierarchy does not exist')
 
-    while len(currentRoundResults) > 0:
-        currentRoundResults = set()
-        for pos in currentStatus:
-            try:
-                currentRoundResults.add(hier.links[pos.code])
-            except KeyError:
-                pass
-        currentStatus = [dim.positions[x] for x in currentRoundResults]
-        for r in currentStatus:
-            result.add(r)
-            if r in originalStatus:
-                del currentStatus[currentStatus.index(r)]
-                continue
+    for pos in originalStatus:
+        result.update(hier.ancestors(pos.code))
+    result = set([dim.positions[x] for x in result])
 
     _set_final_status_hier(dim, method, result, originalStatus)
 
@@ -158,11 +145,7 @@ def children(dim, method, hierCode):
         raise HierarchyError(hierCode, 'Hierarchy does not exist')
 
     for pos in currentStatus:
-        try:
-            for x in find_keys(hier.links, pos.code):
-                result.add(x)
-        except KeyError:
-            pass
+        result.update(hier.childIndex.get(pos.code, ()))
 
     _set_final_status_hier(dim, method, result, originalStatus)
 
@@ -181,32 +164,30 @@ def descendants(dim, method, hierCode):
     """
     result = set()
     originalStatus = set(dim.status)
-    currentRoundResults = set('bogus_to_allow_first_iteration')
-    currentStatus = dim.status
     try:
         hier = cubely.HIERS[dim.code][hierCode]
     except:
         raise HierarchyError(hierCode, 'Hierarchy does not exist')
 
-    while len(currentRoundResults) > 0:
-        currentRoundResults = set()
-        for pos in currentStatus:
-            try:
-                for x in find_keys(hier.links, pos.code):
-                    currentRoundResults.add(x)
-            except KeyError:
-                pass
-        currentStatus = [dim.positions[x] for x in currentRoundResults]
-        for r in currentStatus:
-            result.add(r)
-            if r in originalStatus:
-                del currentStatus[currentStatus.index(r)]
-                continue
+    for pos in originalStatus:
+        result.update(hier.descendants(pos.code))
+    result = set([dim.positions[x] for x in result])
 
     _set_final_status_hier(dim, method, result, originalStatus)
 
 
 def last_descendants(dim, method, hierCode):
+    """
+    Limit a dimension to the positions at the bottom of the hierarchy below the
+    positions currently in status
+    Generaly not used directly but called by the lmt function. Returns nothing.
+
+    Keywords arguments:
+    dim -- the dimension object to limit
+    method -- a method function (add, to, keep, remove)
+    hierCode -- code of the hierarchy to work with
+
+    """
     result = set()
     originalStatus = set(dim.status)
     try:
@@ -214,14 +195,13 @@ def last_descendants(dim, method, hierCode):
     except:
         raise HierarchyError(hierCode, 'Hierarchy does not exist')
 
-    lmt(dim, method, descendants, hierCode)
-    ancestors = set(hier.links.values())
-    for pos in dim:
-        if pos.code not in ancestors:
-            result.add(pos)
+    for pos in originalStatus:
+        for x in hier.descendants(pos.code):
+            if x not in hier.childIndex:
+                result.add(dim.positions[x])
 
     _set_final_status_hier(dim, method, result, originalStatus)
-    
+
 
 #def first(dim, method, hierCode):
 def first(dim, method, numItems):
@@ -307,9 +287,7 @@ def lmt(dim, method, fn = None, hierCode = None):
 
     # Special case method complement
     if method == complement:
-        currentStatus = dimObj.status
-        dimObj.status_all()
-        dimObj.status_remove(currentStatus)
+        dimObj.status_complement()
         return
         
     # General case
@@ -458,21 +436,29 @@ def rpr(obj, downDim=None, acrossDim=None, pageDims=None, title=None, debug=Fals
                 lineIndex = 0
                 colIndex = 0
 
+                # the cells of the page are read in one batch
+                pageCoordinates = []
+                for line in downDim:
+                    for col in cols[1:]:
+                        coordinates = {}
+                        if page.code != 'NONE':
+                            coordinates[page.code] = p.code
+                        if col.code != 'None':
+                            coordinates[acrossDim.code] = col.code
+                        coordinates[downDim.code] = line.code
+                        pageCoordinates.append(coordinates)
+                pageCells = iter(obj.get_many(pageCoordinates))
+
                 for line in downDim:
                     if lineIndex == 0:
                         print formatCols % contentCols
 
                     for col in cols:
                         if colIndex > 0:
-                            coordinates = {}
-                            if page.code != 'NONE':
-                                coordinates[page.code] = p.code
-                            if col.code != 'None':
-                                coordinates[acrossDim.code] = col.code
-                            coordinates[downDim.code] = line.code
+                            coordinates, cellVal = pageCells.next()
                             if debug:
                                 print coordinates
-                            lineContent.append(obj.get(coordinates))
+                            lineContent.append(cellVal)
                         else:
                             lineContent = [line.code]
 
@@ -484,7 +470,7 @@ def rpr(obj, downDim=None, acrossDim=None, pageDims=None, title=None, debug=Fals
                     lineIndex += 1
     print ' '
 
-def aggregate(cube, parallel_aggreg=False, partial_aggreg=False):
+def aggregate(cube, parallel_aggreg=False, partial_aggreg=False, pushdown=False):
     """
     Fully aggregate a cube, whatever the current statuses are.
 
@@ -494,6 +480,7 @@ def aggregate(cube, parallel_aggreg=False, partial_aggreg=False):
     Keywords arguments:
     parallel_aggreg -- boolean, level of parallelism to be used (default=False, no parallelism)
     partial_aggreg -- list, list of dimensions to aggregate if not all (default=False)
+    pushdown -- boolean, run the rollups as mongodb aggregation pipelines (default=False)
 
     """
     # @TODO : multithreaded aggregation. multiprocessing.cpu_count() to get the number of cores
@@ -511,7 +498,9 @@ def aggregate(cube, parallel_aggreg=False, partial_aggreg=False):
                     hiers = cubely.HIERS[dimCode]
                     for hierCode in hiers:
                         cube_log('['+cube.code+'] Rolling up dimension ' + dimCode + ' over hierarchy ' + hierCode, 2)
-                        if parallel_aggreg:
+                        if pushdown and cube.storage != 'chunked':
+                            rollup_pushdown(cube, cubely.DIMS[dimCode], cubely.HIERS[dimCode][hierCode])
+                        elif parallel_aggreg:
                             rollup(cube, copy.copy(cubely.DIMS[dimCode]), copy.copy(cubely.HIERS[dimCode][hierCode]))
                         else:
                             rollup(cube, cubely.DIMS[dimCode], cubely.HIERS[dimCode][hierCode])
@@ -524,79 +513,175 @@ def aggregate(cube, parallel_aggreg=False, partial_aggreg=False):
             _restore_status(dimCode, timestamp)
 
 
-def rollup(cube, dim, hier):
+def _hier_levels(hier):
+    """
+    Group the positions of a hierarchy in levels for aggregation: the leaves
+    first, then each position once all its children are in previous levels.
+    Return a list of lists of position codes. Internal use only.
+
+    Keywords arguments:
+    hier -- cubely.Hierarchy object to use
+
+    """
+    childCount = {}
+    for parentCode in hier.links.itervalues():
+        childCount[parentCode] = childCount.get(parentCode, 0) + 1
+    levels = []
+    level = [code for code in hier.links.iterkeys() if code not in childCount]
+    while len(level) > 0:
+        levels.append(level)
+        nextLevel = []
+        for code in level:
+            parentCode = hier.links.get(code)
+            if parentCode is None:
+                continue
+            childCount[parentCode] -= 1
+            if childCount[parentCode] == 0:
+                nextLevel.append(parentCode)
+        level = nextLevel
+    return levels
+
+
+def rollup(cube, dim, hier, restrict=None):
     """
-    Aggregate a cube over 1 hierarchy. Status dependant.
+    Aggregate a cube over 1 hierarchy, one hierarchy level at a time: the cells
+    of a level are read in one pass, summed by parent cell, and the parent sums
+    are written back in bulk. A parent cell holds the sum of its children cells.
 
     Keywords arguments:
     cube -- cube to aggregate
     dim -- dimension along which aggregate
     hier -- hierarchy name to use (must belong to dim)
+    restrict -- dict of position codes lists by dimension code (other than dim)
+                limiting the aggregated cells to a slice of the cube (default None)
+
+    """
+    dims = list(cube.dimensions)
+    # parent cells already holding the sum of children of previous levels
+    rolledUp = set()
+    cellCounter = 0
+    levelCounter = 0
+    for level in _hier_levels(hier):
+        childCodes = [code for code in level if code in hier.links]
+        if len(childCodes) == 0:
+            continue
+        # Sum the cells of the level by parent cell
+        sums = {}
+        levelRestrict = dict(restrict or {})
+        levelRestrict[dim.code] = childCodes
+        for cell, cellVal in cube.stored_cells(levelRestrict):
+            if cellVal is None:
+                continue
+            cell[dim.code] = hier.links[cell[dim.code]]
+            parentTup = tuple([cell[d] for d in dims])
+            sums[parentTup] = sums.get(parentTup, 0) + cellVal
+        # Write the parent sums
+        for parentTup, parentVal in sums.iteritems():
+            parentCell = dict(zip(dims, parentTup))
+            if parentTup in rolledUp:
+                parentVal += cube.get(parentCell)
+            else:
+                rolledUp.add(parentTup)
+            cube.set(parentCell, parentVal)
+            cellCounter += 1
+            if cellCounter > UPDATE_INTERVAL:
+                cube_log('['+cube.code+'] Updating cube after ' + str(cellCounter) + ' records', 3)
+                cube.update()
+                cellCounter = 0
+        cube_log('['+cube.code+'] Done with level ' + str(levelCounter) + '. Parent cells computed: ' + str(len(sums)), 3)
+        levelCounter += 1
+        # Warning: we must update the cube after each level otherwise the parent cells
+        # are not pushed back in the collection read by the next level
+        cube.update()
+    cube.declare_aggregated_dim(dim.code)
+    cube.update()
+
+
+def rollup_pushdown(cube, dim, hier, restrict=None):
+    """
+    Aggregate a cube over 1 hierarchy inside mongodb. Same result as rollup, but
+    each hierarchy level is compiled into an aggregation pipeline that maps the
+    children to their parent, groups the cells by parent cell and merges the
+    sums back in the cube collection, so the cells never leave the server.
+    Not available for chunked cubes. Needs mongodb 4.4 or later
+    (PUSHDOWN_MIN_SERVER_VERSION): older servers aggregate with rollup.
+
+    Keywords arguments:
+    cube -- cube to aggregate
+    dim -- dimension along which aggregate
+    hier -- hierarchy name to use (must belong to dim)
+    restrict -- dict of position codes lists by dimension code (other than dim)
+                limiting the aggregated cells to a slice of the cube (default None)
 
     """
-    # 1) lmt to last descendants IN STATUS
-    # 2) for each one, add its own value to its parent
-    # 3) lmt to parents
-    # 4) "rinse and repeat" until only positions with no parents are in status
-    # @TODO : test with recursion to see if it improves performance
-    nextVal = None
-    originalStatus = copy.copy(dim.status)
+    if cube.storage == 'chunked':
+        raise CubeError(cube.code, 'Chunked cubes cannot be aggregated by mongodb')
+    serverVersion = tuple(cubely.db.db.command('buildinfo')['versionArray'][:2])
+    if serverVersion < PUSHDOWN_MIN_SERVER_VERSION:
+        cube_log('['+cube.code+'] mongodb ' + '.'.join([str(v) for v in serverVersion]) + ' cannot aggregate, rolling up in memory', 3)
+        rollup(cube, dim, hier, restrict)
+        return
+    # the pipelines only see the cells written back
+    cube.update()
+    dims = list(cube.dimensions)
+    otherDims = [d for d in dims if d != dim.code]
+    # parent cells merged by this rollup are flagged with the token, so that the
+    # sums of later levels or batches are added to them instead of replacing them
+    token = _get_timestamp_hash()
+    levelCounter = 0
     try:
-        potentials = set(hier.links.keys())
-        ancestors = set(hier.links.values())
-        lastDescendants = potentials.difference(ancestors)
-        lmt(dim, to, list(lastDescendants))
-        cellCounter = 0
-        levelCounter = 0
-        while dim.statlen() > 0:
-            # For each position in status in the aggregated dim ...
-            for el in dim:
-                if cellCounter > UPDATE_INTERVAL:
-                    cube_log('['+cube.code+'] Updating cube after ' + str(cellCounter) + ' records', 3)
-                    cube.update()
-                    cellCounter = 0
-                # Retrieve the cells currently existing for this position
-                cells = cube.cubeCollection.find({dim.code: el.code})
-                for cell in cells:
-                    dimsTup = {}
-                    del(cell['_id'])
-                    cellVal = cell['value']
-                    del(cell['value'])
-                    dimsTup = copy.copy(cell)
-                    dimsTup[dim.code] = hier.links[el.code]
-                    currentVal = cube.get(dimsTup)
-                    if currentVal is None:
-                        nextVal = cellVal
-                    else:
-                        nextVal = cellVal+currentVal
-
-                if nextVal is not None:
-                    '''if cube.code=='RENTALS':
-                        print(dimsTup)
-                        try:
-                            print(nextVal)
-                        except UnboundLocalError:
-                            print(0)'''
-                    cube.set(dimsTup, nextVal)
-                cellCounter += 1
-
-            lmt(dim, to, parents, hier.code)
-            cube_log('['+cube.code+'] Done with level ' + str(levelCounter) + '. Parents to compute: ' + str(dim.statlen()), 3)
+        for level in _hier_levels(hier):
+            childCodes = [code for code in level if code in hier.links]
+            for batchStart in range(0, len(childCodes), PUSHDOWN_BATCH_SIZE):
+                batch = childCodes[batchStart:batchStart + PUSHDOWN_BATCH_SIZE]
+                # the parent mapping of the batch is shipped as two literal arrays
+                parentExpr = {'$arrayElemAt': [
+                    {'$literal': [hier.links[code] for code in batch]},
+                    {'$indexOfArray': [{'$literal': batch}, '$' + dim.code]}
+                ]}
+                groupId = dict([(d, '$' + d) for d in otherDims])
+                groupId[dim.code] = parentExpr
+                outputFields = dict([(d, '$_id.' + d) for d in dims])
+                outputFields.update({'_id': 0, 'value': 1, '_rollup': {'$literal': token}})
+                match = {dim.code: {'$in': batch}}
+                if restrict:
+                    for dimCode in restrict.keys():
+                        match[dimCode] = {'$in': list(restrict[dimCode])}
+                pipeline = [
+                    {'$match': match},
+                    {'$group': {'_id': groupId, 'value': {'$sum': '$value'}}},
+                    {'$project': outputFields},
+                    {'$merge': {
+                        'into': cube.collectionName,
+                        'on': dims,
+                        'whenMatched': [{'$set': {
+                            'value': {'$cond': [
+                                {'$eq': ['$_rollup', token]},
+                                {'$add': ['$value', '$$new.value']},
+                                '$$new.value'
+                            ]},
+                            '_rollup': token
+                        }}],
+                        'whenNotMatched': 'insert'
+                    }}
+                ]
+                cube.cubeCollection.aggregate(pipeline, cursor={})
+            cube_log('['+cube.code+'] Done with level ' + str(levelCounter) + ' in mongodb', 3)
             levelCounter += 1
-            # Warning: we must update the cube after dim otherwise the changes are not 
-            # pushed back in the collection (used to define perimeter at the begining of the loop)
-            cube.declare_aggregated_dim(dim.code)
-            cube.update()
-
     finally:
-        dim.status = originalStatus
+        cube.cubeCollection.update({'_rollup': token}, {'$unset': {'_rollup': 1}}, multi=True)
+        # cells read before the rollup may be stale
+        cube._values = cube._new_store()
+        cube._notify_change()
+    cube.declare_aggregated_dim(dim.code)
+    cube.update()
 
 
 def dyn_aggregate(cube, posTuple, hiers):
     result = 0
     tmpVal = cube.get(posTuple)
     if tmpVal != None:
-        return cube.get(posTuple)
+        return tmpVal
 
     toAggregateDims = cube.dimensions.difference(cube.aggregatedDims)
     notToAggregateDims = cube.dimensions.intersection(cube.aggregatedDims)
@@ -611,12 +696,12 @@ def dyn_aggregate(cube, posTuple, hiers):
         lmt(dim, to, posTuple[dim])
         if hiers.has_key(dim):
             lmt(dim, to, last_descendants, hiers[dim])
-    queryList = cubely.common.get_status_nuplet(cube.dimensions)
+    # only the stored cells are read, the statuses are captured before being restored
+    cells = cubely.common.iter_status_cells(cube)
 
     for dim in cube.dimensions:
         _restore_status(dim, timestamp)
-    for query in queryList:
-        cellVal = cube.get(query)
+    for cell, cellVal in cells:
         if type(cellVal) is NoneType:
             cellVal = 0
         result += cellVal
@@ -676,32 +761,56 @@ def _restore_status(dim, token=False):
     del DIMS_TEMPORARY_STATUS[threadName][dimCode][token]
 
 
-def check_hier(hier):
+def check_hier(hier, force=False):
     """
-    Index a hierarchy for sorting
+    Index a hierarchy for sorting. The ordering index is computed in memory,
+    kept in hier.order and written back in bulk, only when the links changed
+    since the last index.
 
     Keywords arguments:
     hier -- cubely.Hierarchy object to use
+    force -- index the hierarchy even if it did not change (default False)
 
     """
-    dim = cubely.DIMS[hier.dimension]
-    timestamp = _get_timestamp_hash()
-    _snapshot_status(dim, timestamp)
-    try:
-        ancestors = set(hier.links.values())
-        childs = set(hier.links.keys())
-        topAncestors = ancestors.difference(childs)
-        index = 0
-
-        lmt(dim, to, list(topAncestors))
-
-        while dim.statlen() > 0:
-            for pos in dim.status:
-                hier.hierCollection.update({'code': pos.code}, {"$set": {"index": index}})
-                index += 1
-            lmt(dim, to, children, hier.code)
-    finally:
-        _restore_status(dim, timestamp)
+    if hier.indexedVersion == hier.version and not force:
+        return
+    order = hier.compute_order()
+    # the top positions have no document in the hierarchy collection
+    def _operations():
+        for code, index in order.iteritems():
+            yield {'code': code}, {"$set": {"index": index}}
+    cubely.common.bulk_write(hier.hierCollection, _operations(), cubely.core.UPDATE_BATCH_SIZE, upsert=False)
+    hier.order = order
+    hier.indexedVersion = hier.version
+    hier.mark_indexed()
+
+
+def hier_sort_key(dim, hier):
+    """
+    Return a function giving the sort key of a position in the hierarchy order,
+    for list.sort or sorted. The positions out of the hierarchy come last.
+
+    Keywords arguments:
+    dim -- Dimension object or name of the positions
+    hier -- Hierarchy name to use for sorting
+
+    """
+    order = get_hier_object(get_dim_object(dim), hier).get_order()
+    last = len(order)
+    return lambda pos: order.get(pos.code, last)
+
+
+def alpha_sort_key(dim):
+    """
+    Return a function giving the alphabetical sort key of a position, for
+    list.sort or sorted.
+
+    Keywords arguments:
+    dim -- Dimension object or name of the positions
+
+    """
+    keys = get_dim_object(dim).get_alpha_keys()
+    return lambda pos: keys.get(pos.code) or pos.code.lower()
 
 
 def sorth(dim, hier):
@@ -714,23 +823,7 @@ def sorth(dim, hier):
 
     """
     dimObj = get_dim_object(dim)
-    hierObj = get_hier_object(dimObj, hier)
-    def _sort(x, y):
-        indexX = hierObj.hierCollection.find_one({'code': x.code})
-        indexY = hierObj.hierCollection.find_one({'code': y.code})
-        try:
-            if indexX['index'] > indexY['index']:
-                return 1
-            elif indexX['index'] == indexY['index']:
-                return 0
-            else:  #x < y
-                return -1
-        except TypeError:
-            if x.code in hierObj.links.values() and x.code not in hierObj.links.keys():
-                return -1
-            else:
-                return 1
-    dimObj.status.sort(_sort)
+    dimObj.status.sort(key=hier_sort_key(dimObj, hier))
 
 
 def sorta(dim):
@@ -742,33 +835,22 @@ def sorta(dim):
 
     """
     dimObj = get_dim_object(dim)
-    dimObj.status.sort(lambda x, y: cmp(x.code.lower(),y.code.lower()))
+    dimObj.status.sort(key=alpha_sort_key(dimObj))
 
 
 def total(cube, dims):
-    inList = {}
-    dimObjs = []
-    resultsList = set()
-    _total = 0
-
-    for dim in dims:
-        dimObj = get_dim_object(dim)
-        dimObjs.append(dimObj)
+    """
+    Sum the stored cells of a cube in the status of the given dimensions. Return the total.
 
-    for dim in dimObjs:
-        posList = []
-        for pos in dim:
-            posList.append(pos.code)
-        inList[dim.code]=copy.copy(posList)
+    Keywords arguments:
+    cube -- cube to sum
+    dims -- list of dimensions objects or names whose status limits the cells
 
-    for dim in dimObjs:
-        inClause = {dim.code: {'$in': inList[dim.code]}}
-        results = cube.cubeCollection.find(inClause)
-        for res in results:
-            resultsList.add(res)
+    """
+    _total = 0
 
-    for res in resultsList:
-        _total += res['value']
+    for cell, cellVal in cubely.common.iter_status_cells(cube, dims):
+        _total += cellVal
 
     return _total
 
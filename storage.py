@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+"""Cell storage backends for cubely cubes"""
+
+from array import array
+import struct
+
+try:
+    from bson.binary import Binary
+except ImportError:
+    # pymongo < 1.9
+    from pymongo.binary import Binary
+
+import cubely
+import cubely.common
+from cubely.errors import CubeError
+
+# *** Constants
+STORAGES = ['dict', 'dense', 'chunked']
+ARRAY_TYPECODES = {'int': 'l', 'float': 'd', 'boolean': 'b'}
+# the chunks are persisted as little-endian values of a fixed size, whatever the platform
+SERIAL_FORMATS = {'int': 'q', 'float': 'd', 'boolean': 'b'}
+CHUNK_CELLS = 4096      # targeted number of cells in a chunk of a chunked store
+
+
+# *** Functions
+def get_store(storage, dims, type, collection=None):
+    """
+    Return an empty cell store for a cube. The store is used like a dict whose
+    keys are tuples of position codes, ordered as dims.
+
+    Keywords arguments:
+    storage -- storage mode (dict, dense, chunked)
+    dims -- ordered list of the codes of the cube dimensions
+    type -- type of the cube values
+    collection -- mongodb collection of the cube, used by chunked stores (default None)
+
+    """
+    if storage == 'dict':
+        return {}
+    elif storage == 'dense':
+        return DenseStore(dims, type)
+    elif storage == 'chunked':
+        return ChunkedStore(dims, type, collection)
+    else:
+        raise CubeError(storage, 'Invalid cube storage')
+
+
+# *** Classes definition
+class _OrdinalStore(object):
+    """
+    Base class of the array stores. Maps the position codes of each dimension to
+    integer ordinals, in order of first use, and provides the dict interface on
+    top of the _lookup/__setitem__/__delitem__/iteritems methods of subclasses.
+    Private.
+    """
+    dims = []
+    type = ''
+    typecode = ''
+    ordinals = []
+    codes = []
+    length = 0
+
+    def __init__(self, dims, type):
+        try:
+            self.typecode = ARRAY_TYPECODES[type]
+        except KeyError:
+            raise CubeError(type, 'Cube type cannot be stored in an array')
+        self.dims = list(dims)
+        self.type = type
+        self.ordinals = [{} for d in self.dims]
+        self.codes = [[] for d in self.dims]
+        self.length = 0
+
+    def _key_ordinals(self, key, create=False):
+        """
+        Return the tuple of ordinals of a key. Unknown codes raise KeyError unless
+        create is True, in which case they get the next ordinal. Private.
+        """
+        if len(key) != len(self.dims):
+            raise KeyError(key)
+        ordinals = []
+        for dimIndex in range(len(self.dims)):
+            try:
+                ordinal = self.ordinals[dimIndex][key[dimIndex]]
+            except KeyError:
+                if not create:
+                    raise
+                ordinal = len(self.codes[dimIndex])
+                self.ordinals[dimIndex][key[dimIndex]] = ordinal
+                self.codes[dimIndex].append(key[dimIndex])
+            ordinals.append(ordinal)
+        return tuple(ordinals)
+
+    def _key(self, ordinals):
+        """Return the key of a tuple of ordinals. Private."""
+        return tuple([self.codes[dimIndex][ordinals[dimIndex]] for dimIndex in range(len(self.dims))])
+
+    def _cast(self, value):
+        """Return a value read from an array as the cube type. Private."""
+        if self.type == 'boolean':
+            return bool(value)
+        return value
+
+    def __contains__(self, key):
+        try:
+            self._lookup(key)
+            return True
+        except KeyError:
+            return False
+
+    def has_key(self, key):
+        return key in self
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iterkeys(self):
+        for key, value in self.iteritems():
+            yield key
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [value for key, value in self.iteritems()]
+
+
+class DenseStore(_OrdinalStore):
+    """
+    Cube cells held in one typed array. A cell lives at the row-major offset of
+    its ordinals. A byte per cell flags the cells holding a value.
+    """
+    extents = []
+    data = None
+    filled = None
+
+    def __init__(self, dims, type):
+        _OrdinalStore.__init__(self, dims, type)
+        # Size the array after the current dimensions. It grows as positions are added.
+        self.extents = []
+        for d in self.dims:
+            try:
+                self.extents.append(max(len(cubely.DIMS[d].positions), 1))
+            except KeyError:
+                self.extents.append(1)
+        self._allocate()
+
+    def _allocate(self):
+        """Allocate empty arrays for the current extents. Private."""
+        size = 1
+        for extent in self.extents:
+            size *= extent
+        self.data = array(self.typecode, [0]) * size
+        self.filled = bytearray(size)
+
+    def _offset(self, ordinals):
+        """Return the array offset of a tuple of ordinals. Private."""
+        offset = 0
+        for dimIndex in range(len(self.dims)):
+            offset = offset * self.extents[dimIndex] + ordinals[dimIndex]
+        return offset
+
+    def _ordinals(self, offset):
+        """Return the tuple of ordinals stored at an array offset. Private."""
+        ordinals = []
+        for dimIndex in range(len(self.dims) - 1, -1, -1):
+            offset, ordinal = divmod(offset, self.extents[dimIndex])
+            ordinals.append(ordinal)
+        ordinals.reverse()
+        return tuple(ordinals)
+
+    def _lookup(self, key):
+        """Return the array offset of an existing key. Raise KeyError otherwise. Private."""
+        offset = self._offset(self._key_ordinals(key))
+        if not self.filled[offset]:
+            raise KeyError(key)
+        return offset
+
+    def _grow(self, newExtents):
+        """Re-layout the array for larger extents. Private."""
+        cells = [(self._ordinals(offset), self.data[offset]) for offset in self._iter_offsets()]
+        self.extents = newExtents
+        self._allocate()
+        for ordinals, value in cells:
+            offset = self._offset(ordinals)
+            self.data[offset] = value
+            self.filled[offset] = 1
+
+    def _iter_offsets(self):
+        """Yield the offsets of the filled cells, in array order. Private."""
+        offset = self.filled.find('\x01')
+        while offset >= 0:
+            yield offset
+            offset = self.filled.find('\x01', offset + 1)
+
+    def __getitem__(self, key):
+        return self._cast(self.data[self._lookup(key)])
+
+    def __setitem__(self, key, value):
+        ordinals = self._key_ordinals(key, True)
+        newExtents = None
+        for dimIndex in range(len(self.dims)):
+            if ordinals[dimIndex] >= self.extents[dimIndex]:
+                if not newExtents:
+                    newExtents = list(self.extents)
+                newExtents[dimIndex] = self.extents[dimIndex] * 2
+        if newExtents:
+            self._grow(newExtents)
+        offset = self._offset(ordinals)
+        if not self.filled[offset]:
+            self.filled[offset] = 1
+            self.length += 1
+        self.data[offset] = value
+
+    def __delitem__(self, key):
+        offset = self._lookup(key)
+        self.filled[offset] = 0
+        self.data[offset] = 0
+        self.length -= 1
+
+    def clear(self):
+        self.length = 0
+        self._allocate()
+
+    def iteritems(self):
+        """Yield the (key, value) of the filled cells by walking the array in order."""
+        for offset in self._iter_offsets():
+            yield self._key(self._ordinals(offset)), self._cast(self.data[offset])
+
+
+class ChunkedStore(_OrdinalStore):
+    """
+    Sparse cube cells. The ordinals space is cut in fixed size chunks and only
+    the chunks holding at least one value are allocated. Each chunk is a typed
+    array of values plus an occupancy bitmap, and is persisted in the cube
+    collection as one document holding both as binary blobs:
+    {'chunk': [chunk coordinates], 'values': <blob>, 'bitmap': <blob>, 'count': n}
+    The codes of the ordinals are persisted as one document per dimension:
+    {'ordinals': dim code, 'codes': [codes by ordinal]}
+    The chunk coordinates and the cells in a chunk follow the sorted order of
+    the dims, whatever the order of the keys: the order of the dims of a cube
+    may change from a session to the next.
+    The store is loaded from the collection on first access.
+    """
+    side = 0
+    layout = []
+    chunkAxes = []
+    chunkCells = 0
+    chunks = {}
+    dirtyChunks = set()
+    savedCodes = []
+    collection = None
+    loaded = False
+
+    def __init__(self, dims, type, collection=None):
+        _OrdinalStore.__init__(self, dims, type)
+        # Chunks are hypercubes of side positions along each dimension
+        self.side = max(2, int(round(CHUNK_CELLS ** (1.0 / max(len(self.dims), 1)))))
+        self.chunkCells = self.side ** len(self.dims)
+        # index in the keys of the dim of each chunk axis, and the reverse
+        self.layout = [self.dims.index(d) for d in sorted(self.dims)]
+        self.chunkAxes = [sorted(self.dims).index(d) for d in self.dims]
+        self.chunks = {}
+        self.dirtyChunks = set()
+        self.savedCodes = [0 for d in self.dims]
+        self.collection = collection
+        self.loaded = collection is None
+
+    def __deepcopy__(self, memo):
+        self._load()
+        newone = ChunkedStore(self.dims, self.type)
+        newone.ordinals = [dict(o) for o in self.ordinals]
+        newone.codes = [list(c) for c in self.codes]
+        newone.length = self.length
+        for chunkKey, chunk in self.chunks.iteritems():
+            newone.chunks[chunkKey] = [array(self.typecode, chunk[0]), bytearray(chunk[1]), chunk[2]]
+        return newone
+
+    def _load(self):
+        """Read the chunks and ordinals from the cube collection, once. Private."""
+        if self.loaded:
+            return
+        self.loaded = True
+        for doc in self.collection.find({'ordinals': {'$exists': True}}):
+            dimIndex = self.dims.index(doc['ordinals'])
+            self.codes[dimIndex] = list(doc['codes'])
+            self.ordinals[dimIndex] = dict([(code, ordinal) for ordinal, code in enumerate(self.codes[dimIndex])])
+            self.savedCodes[dimIndex] = len(self.codes[dimIndex])
+        for doc in self.collection.find({'chunk': {'$exists': True}}):
+            values = self._unpack_values(doc['values'])
+            self.chunks[tuple(doc['chunk'])] = [values, bytearray(str(doc['bitmap'])), doc['count']]
+            self.length += doc['count']
+
+    def _pack_values(self, values):
+        """Return the blob persisting the values of a chunk. Private."""
+        return Binary(struct.pack('<%d%s' % (len(values), SERIAL_FORMATS[self.type]), *values))
+
+    def _unpack_values(self, blob):
+        """Return the array of the values of a chunk persisted as a blob. Private."""
+        blob = str(blob)
+        serialFormat = SERIAL_FORMATS[self.type]
+        if len(blob) == self.chunkCells * struct.calcsize('<' + serialFormat):
+            values = struct.unpack('<%d%s' % (self.chunkCells, serialFormat), blob)
+        elif self.type == 'int' and len(blob) == self.chunkCells * 4:
+            # chunks written with the native 4 bytes longs of 32 bits and Windows builds
+            values = struct.unpack('<%di' % self.chunkCells, blob)
+        else:
+            raise CubeError(self.type, 'Invalid chunk values size')
+        try:
+            return array(self.typecode, values)
+        except OverflowError:
+            raise CubeError(self.type, 'Chunk values too large for this platform')
+
+    def _locate(self, ordinals):
+        """Return the chunk key and the offset in the chunk of a tuple of ordinals. Private."""
+        chunkKey = []
+        offset = 0
+        for dimIndex in self.layout:
+            chunkCoord, inChunk = divmod(ordinals[dimIndex], self.side)
+            chunkKey.append(chunkCoord)
+            offset = offset * self.side + inChunk
+        return tuple(chunkKey), offset
+
+    def _ordinals(self, chunkKey, offset):
+        """Return the tuple of ordinals of an offset in a chunk. Private."""
+        ordinals = [0 for d in self.dims]
+        for axis in range(len(self.dims) - 1, -1, -1):
+            offset, inChunk = divmod(offset, self.side)
+            ordinals[self.layout[axis]] = chunkKey[axis] * self.side + inChunk
+        return tuple(ordinals)
+
+    def _lookup(self, key):
+        """Return the chunk key, chunk and offset of an existing key. Raise KeyError otherwise. Private."""
+        self._load()
+        chunkKey, offset = self._locate(self._key_ordinals(key))
+        chunk = self.chunks[chunkKey]
+        if not chunk[1][offset >> 3] & (1 << (offset & 7)):
+            raise KeyError(key)
+        return chunkKey, chunk, offset
+
+    def __getitem__(self, key):
+        chunkKey, chunk, offset = self._lookup(key)
+        return self._cast(chunk[0][offset])
+
+    def __setitem__(self, key, value):
+        self._load()
+        chunkKey, offset = self._locate(self._key_ordinals(key, True))
+        try:
+            chunk = self.chunks[chunkKey]
+        except KeyError:
+            chunk = [array(self.typecode, [0]) * self.chunkCells, bytearray((self.chunkCells + 7) >> 3), 0]
+            self.chunks[chunkKey] = chunk
+        mask = 1 << (offset & 7)
+        if not chunk[1][offset >> 3] & mask:
+            chunk[1][offset >> 3] |= mask
+            chunk[2] += 1
+            self.length += 1
+        chunk[0][offset] = value
+        self.dirtyChunks.add(chunkKey)
+
+    def __delitem__(self, key):
+        chunkKey, chunk, offset = self._lookup(key)
+        chunk[1][offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+        chunk[0][offset] = 0
+        chunk[2] -= 1
+        self.length -= 1
+        if chunk[2] == 0:
+            # empty chunks are not kept
+            del self.chunks[chunkKey]
+        self.dirtyChunks.add(chunkKey)
+
+    def clear(self):
+        self._load()
+        self.dirtyChunks.update(self.chunks.keys())
+        self.chunks = {}
+        self.length = 0
+
+    def _iter_chunk(self, chunkKey, chunk, allowed=None):
+        """Yield the (ordinals, value) of the filled cells of a chunk. Private."""
+        bitmap = chunk[1]
+        for byteIndex in xrange(len(bitmap)):
+            byte = bitmap[byteIndex]
+            if not byte:
+                continue
+            for bit in xrange(8):
+                if byte & (1 << bit):
+                    offset = (byteIndex << 3) + bit
+                    ordinals = self._ordinals(chunkKey, offset)
+                    if allowed:
+                        skip = False
+                        for dimIndex in range(len(self.dims)):
+                            if allowed[dimIndex] is not None and ordinals[dimIndex] not in allowed[dimIndex]:
+                                skip = True
+                                break
+                        if skip:
+                            continue
+                    yield ordinals, self._cast(chunk[0][offset])
+
+    def iteritems(self, restrict=None):
+        """
+        Yield the (key, value) of the filled cells. Empty chunks are never visited.
+
+        Keywords arguments:
+        restrict -- list, by dimension, of the allowed position codes or None for
+                    all positions (default None, all cells)
+
+        """
+        self._load()
+        allowed = None
+        allowedChunks = None
+        if restrict:
+            allowed = []
+            allowedChunks = []
+            for dimIndex in range(len(self.dims)):
+                if restrict[dimIndex] is None:
+                    allowed.append(None)
+                    allowedChunks.append(None)
+                else:
+                    ordinals = set([self.ordinals[dimIndex][code] for code in restrict[dimIndex] if code in self.ordinals[dimIndex]])
+                    allowed.append(ordinals)
+                    allowedChunks.append(set([ordinal // self.side for ordinal in ordinals]))
+        for chunkKey, chunk in self.chunks.items():
+            if allowedChunks:
+                skip = False
+                for dimIndex in range(len(self.dims)):
+                    if allowedChunks[dimIndex] is not None and chunkKey[self.chunkAxes[dimIndex]] not in allowedChunks[dimIndex]:
+                        skip = True
+                        break
+                if skip:
+                    continue
+            for ordinals, value in self._iter_chunk(chunkKey, chunk, allowed):
+                yield self._key(ordinals), value
+
+    def remove_code(self, dim, code):
+        """
+        Empty all the cells of a position, in memory only. Return the set of the
+        keys of the chunks changed.
+
+        Keywords arguments:
+        dim -- code of the dimension of the position
+        code -- code of the position
+
+        """
+        restrict = [None for d in self.dims]
+        restrict[self.dims.index(dim)] = [code]
+        keys = [key for key, value in self.iteritems(restrict)]
+        chunkKeys = set()
+        for key in keys:
+            chunkKeys.add(self._locate(self._key_ordinals(key))[0])
+            del self[key]
+        return chunkKeys
+
+    def delete_code(self, dim, code, batchSize):
+        """
+        Empty all the cells of a position, in memory and in the collection,
+        without writing the other changes not saved yet: the chunks holding some
+        are patched in the collection instead of being saved. Return the number
+        of chunks changed.
+
+        Keywords arguments:
+        dim -- code of the dimension of the position
+        code -- code of the position
+        batchSize -- number of documents per bulk operation
+
+        """
+        self._load()
+        dimIndex = self.dims.index(dim)
+        ordinal = self.ordinals[dimIndex].get(code)
+        if ordinal is None:
+            return 0
+        pending = set(self.dirtyChunks)
+        chunkKeys = self.remove_code(dim, code)
+        # the chunks without other changes are saved as they are in memory
+        self.save(batchSize, chunkKeys.difference(pending))
+        if ordinal < self.savedCodes[dimIndex]:
+            # the cells of the position may be saved in the other chunks
+            for chunkKey in pending:
+                if chunkKey[self.chunkAxes[dimIndex]] == ordinal // self.side:
+                    self._remove_saved(chunkKey, dimIndex, ordinal)
+        return len(chunkKeys)
+
+    def _remove_saved(self, chunkKey, dimIndex, ordinal):
+        """Empty the cells of an ordinal in the saved version of a chunk. Private."""
+        doc = self.collection.find_one({'chunk': list(chunkKey)})
+        if doc is None:
+            return
+        values = self._unpack_values(doc['values'])
+        bitmap = bytearray(str(doc['bitmap']))
+        count = doc['count']
+        for ordinals, value in self._iter_chunk(chunkKey, [values, bitmap, count]):
+            if ordinals[dimIndex] == ordinal:
+                offset = self._locate(ordinals)[1]
+                bitmap[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+                values[offset] = 0
+                count -= 1
+        if count == 0:
+            self.collection.remove({'chunk': list(chunkKey)})
+        else:
+            self.collection.update({'chunk': list(chunkKey)}, {'$set': {
+                'values': self._pack_values(values),
+                'bitmap': Binary(str(bitmap)),
+                'count': count
+            }})
+
+    def save(self, batchSize, chunkKeys=None):
+        """
+        Write the modified chunks and the new ordinals codes to the collection.
+        Return the number of chunks written.
+
+        Keywords arguments:
+        batchSize -- number of documents per bulk operation
+        chunkKeys -- keys of the chunks to write, if modified (default None, all
+                     the modified chunks)
+
+        """
+        self.collection.ensure_index('chunk', unique=True, sparse=True, background=True)
+        self.collection.ensure_index('ordinals', unique=True, sparse=True, background=True)
+        # ordinals first: the chunks refer to them
+        ordinalsDocs = []
+        for dimIndex in range(len(self.dims)):
+            if len(self.codes[dimIndex]) > self.savedCodes[dimIndex]:
+                ordinalsDocs.append(({'ordinals': self.dims[dimIndex]}, {'$set': {'codes': self.codes[dimIndex]}}))
+                self.savedCodes[dimIndex] = len(self.codes[dimIndex])
+        cubely.common.bulk_write(self.collection, ordinalsDocs, batchSize)
+        if chunkKeys is None:
+            dirtyChunks = self.dirtyChunks
+            self.dirtyChunks = set()
+        else:
+            dirtyChunks = self.dirtyChunks.intersection(chunkKeys)
+            self.dirtyChunks.difference_update(dirtyChunks)
+        emptyChunks = [list(chunkKey) for chunkKey in dirtyChunks if chunkKey not in self.chunks]
+        if emptyChunks:
+            self.collection.remove({'chunk': {'$in': emptyChunks}})
+        def _operations():
+            for chunkKey in dirtyChunks:
+                if chunkKey in self.chunks:
+                    chunk = self.chunks[chunkKey]
+                    yield {'chunk': list(chunkKey)}, {'$set': {
+                        'values': self._pack_values(chunk[0]),
+                        'bitmap': Binary(str(chunk[1])),
+                        'count': chunk[2]
+                    }}
+        return cubely.common.bulk_write(self.collection, _operations(), batchSize)
@@ -8,6 +8,7 @@ from cubely.tests.core.Cube import CubeTestCase
 from cubely.tests.core.Formula import FormulaTestCase
 from cubely.tests.lang.status import StatusTestCase
 from cubely.tests.lang.misc import MiscTestCase
+from cubely.tests.lang.fileread import FilereadTestCase
 
 
 def suite():
@@ -19,6 +20,7 @@ def suite():
     suiteFrm = unittest.TestLoader().loadTestsFromTestCase(FormulaTestCase)
     suiteSta = unittest.TestLoader().loadTestsFromTestCase(StatusTestCase)
     suiteMsc = unittest.TestLoader().loadTestsFromTestCase(MiscTestCase)
+    suiteFil = unittest.TestLoader().loadTestsFromTestCase(FilereadTestCase)
     suite = unittest.TestSuite([
         suiteDb,
         suiteDim,
@@ -27,17 +29,28 @@ def suite():
         suiteCub,
         suiteFrm,
         suiteSta,
-        suiteMsc
+        suiteMsc,
+        suiteFil
     ])
     return suite
 
-try:
-    cubely.db.drop('unittest')
-except:
-    pass
 
-cubely.db.create('unittest', description='Temporary database for unit test')
-cubely.db.close()
+def run():
+    """
+    Run the suite on a new 'unittest' database. The suite is not run on import:
+    the file tests start processes, which would wait for the import lock.
+    """
+    try:
+        cubely.db.drop('unittest')
+    except:
+        pass
 
-runner = unittest.TextTestRunner()
-runner.run(suite())
\ No newline at end of file
+    cubely.db.create('unittest', description='Temporary database for unit test')
+    cubely.db.close()
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
+
+
+if __name__ == '__main__':
+    run()
\ No newline at end of file
@@ -22,11 +22,14 @@ class  CubeTestCase(unittest.TestCase):
         sales = cubely.V_SALES
         sales.set({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}, 10)
         self.assertEqual(sales.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 10, 'check get = set')
-        sales.update()
+        self.assertEqual(sales.update(), 1, 'check number of cells written')
+        self.assertEqual(sales.update(), 0, 'check nothing left to write')
 
     def test_3_getafeterupdate(self):
         sales = cubely.V_SALES
         self.assertEqual(sales.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 10, 'check get = set after update')
+        cells = sales.get_many([{'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}, {'PROD': 'P1', 'GEOG': 'G2', 'TIME':'JAN'}])
+        self.assertEqual([cellVal for pos, cellVal in cells], [10, None], 'check get_many')
 
     def test_4_rollback(self):
         sales = cubely.V_SALES
@@ -51,6 +54,9 @@ class  CubeTestCase(unittest.TestCase):
         rent.set({'PROD': 'P3', 'GEOG': 'G1', 'TIME':'JAN'}, 30)
         rent_dyn_total = dyn_aggregate(rent, {'PROD': 'TOTPROD', 'GEOG': 'G1', 'TIME':'JAN'}, {'PROD':'STD'})
         self.assertEqual(rent_dyn_total, 50, 'check simple dynamic aggregation')
+        rent.update()
+        cubely.lang.aggregate(rent, pushdown=True)
+        self.assertEqual(rent.get({'PROD': 'TOTPROD', 'GEOG': 'G1', 'TIME':'JAN'}), 50, 'check aggregation in mongodb')
 
 
     def test_6_delete(self):
@@ -62,6 +68,48 @@ class  CubeTestCase(unittest.TestCase):
         self.assertTrue('SALES' not in cubely.CUBES.keys(), 'check book keeping after close 1')
         self.assertFalse(hasattr(cubely, 'V_SALES'), 'check book keeping after close 2')
 
+    def test_7_dense_storage(self):
+        dense = cubely.cube.create(['PROD', 'GEOG', 'TIME'], 'float', 'DENSE', 'Dense cube', storage='dense')
+        self.assertEqual(dense._values.__class__, cubely.storage.DenseStore, 'check storage class')
+        dense.set({'PROD': 'P1', 'GEOG': 'G2', 'TIME':'JAN'}, 1.5)
+        self.assertEqual(dense.get({'PROD': 'P1', 'GEOG': 'G2', 'TIME':'JAN'}), 1.5, 'check get = set')
+        self.assertEqual(dense.get({'PROD': 'P2', 'GEOG': 'G2', 'TIME':'JAN'}), None, 'check empty cell')
+        dense.update()
+        cubely.db.close()
+        cubely.db.open('unittest')
+        dense = cubely.V_DENSE
+        self.assertEqual(dense.storage, 'dense', 'check storage after reopen')
+        self.assertEqual(dense.get({'PROD': 'P1', 'GEOG': 'G2', 'TIME':'JAN'}), 1.5, 'check get after reopen')
+        self.assertRaises(cubely.errors.CubeError, cubely.cube.create, ['PROD'], 'string', 'DENSESTR', 'Dense strings', 'dense')
+        cubely.cube.delete('DENSE')
+
+    def test_8_chunked_storage(self):
+        chunked = cubely.cube.create(['PROD', 'GEOG', 'TIME'], 'int', 'CHUNKED', 'Chunked cube', storage='chunked')
+        chunked.set({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}, 4)
+        chunked.set({'PROD': 'P2', 'GEOG': 'G1', 'TIME':'JAN'}, 5)
+        chunked.set({'PROD': 'P2', 'GEOG': 'G2', 'TIME':'JAN'}, 8)
+        chunked.update()
+        cubely.db.close()
+        cubely.db.open('unittest')
+        chunked = cubely.V_CHUNKED
+        self.assertEqual(chunked.get({'PROD': 'P2', 'GEOG': 'G1', 'TIME':'JAN'}), 5, 'check get after reopen')
+        self.assertEqual(chunked.get({'PROD': 'P2', 'GEOG': 'G2', 'TIME':'JAN'}), 8, 'check get after reopen 2')
+        self.assertEqual(chunked.get({'PROD': 'P3', 'GEOG': 'G1', 'TIME':'JAN'}), None, 'check empty cell')
+        self.assertEqual(len(list(chunked.stored_cells())), 3, 'check stored cells')
+        reordered = cubely.storage.get_store('chunked', ['TIME', 'GEOG', 'PROD'], 'int', chunked.cubeCollection)
+        self.assertEqual(reordered.get(('JAN', 'G2', 'P2')), 8, 'check chunks independent of the dims order')
+        cubely.lang.lmt('PROD', cubely.lang.to, ['P1'])
+        self.assertEqual(cubely.lang.total(chunked, ['PROD']), 4, 'check total over status')
+        cubely.D_PROD.add_position('PCHUNK')
+        chunked.set({'PROD': 'PCHUNK', 'GEOG': 'G1', 'TIME':'JAN'}, 6)
+        chunked.update()
+        chunked.set({'PROD': 'P3', 'GEOG': 'G1', 'TIME':'JAN'}, 7)
+        cubely.D_PROD.delete_position('PCHUNK')
+        chunked.rollback()
+        self.assertEqual(chunked.get({'PROD': 'P3', 'GEOG': 'G1', 'TIME':'JAN'}), None, 'check pending cells not written by a position deletion')
+        self.assertEqual(len(list(chunked.stored_cells())), 3, 'check stored cells after position deletion')
+        cubely.cube.delete('CHUNKED')
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
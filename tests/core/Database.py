@@ -24,6 +24,15 @@ class DatabaseTestCase(unittest.TestCase):
         self.assertTrue(cubely.CUBES == {}, 'test close 5')
         self.assertTrue(cubely.FORMULAS == {}, 'test close 6')
 
+    def test_2_open_close_lazy(self):
+        cubely.db.open('unittest')
+        positions = dict([(code, sorted(dim.positions.keys())) for code, dim in cubely.DIMS.items()])
+        cubely.db.close()
+        cubely.db.open('unittest', lazy=True)
+        self.assertEqual(cubely.CURRENT_DB, 'unittest', 'test lazy open')
+        self.assertEqual(dict([(code, sorted(dim.positions.keys())) for code, dim in cubely.DIMS.items()]), positions, 'test lazy open positions')
+        cubely.db.close()
+
     def test_3_collections(self):
         self.assertEquals(type(cubely.db.get_collections()), list)
         self.assertTrue('meta' in cubely.db.get_collections())
@@ -51,6 +51,12 @@ class  DimensionTestCase(unittest.TestCase):
         geog.add_position('G2')
         time = cubely.D_TIME
         time.add_position('JAN')
+        test = cubely.dim.create('TEST', 'Test dim')
+        newPositions = test.add_positions(['T1', ('T2', 'second'), 'T1'], skip_existing=True)
+        self.assertEqual([p.code for p in newPositions], ['T1', 'T2'], 'bulk position creation')
+        self.assertEqual(test.get('T2').description, 'second', 'bulk position description')
+        self.assertRaises(cubely.errors.PositionAlreadyExistsError, test.add_positions, ['T3', 'T1'])
+        self.assertFalse(test.has_position('T3'), 'bulk position creation is all or nothing')
 
     def test_4_status(self):
         prod = cubely.D_PROD
@@ -73,12 +79,20 @@ class  DimensionTestCase(unittest.TestCase):
         self.assertEqual(cubely.lang.statlen(prod), 1, 'dimension status set pos')
         prod.status_remove(['P3'])
         self.assertEqual(cubely.lang.statlen(prod), 0, 'dimension status remove code')
+        self.assertRaises(cubely.errors.PositionError, prod.status_remove, ['NOPOS'])
         prod.status_all()
         self.assertEqual(cubely.lang.statlen(prod), 4, 'allstat prod')
         cubely.D_GEOG.status_all()
         self.assertEqual(cubely.lang.statlen(cubely.D_GEOG), 2, 'allstat geog')
         cubely.DIMS['TIME'].status_all()
         self.assertEqual(cubely.lang.statlen(cubely.DIMS['TIME']), 1, 'allstat time')
+        prod.status_set(['P2', 'TOTPROD'])
+        prod.status_add(['P1'])
+        self.assertEqual([p.code for p in prod.status], ['P2', 'TOTPROD', 'P1'], 'status order kept, added positions last')
+        prod.status_complement()
+        self.assertEqual([p.code for p in prod.status], ['P3'], 'status complement')
+        self.assertEqual(prod.unknown_positions(['P1', 'BOGUS', 'P2']), ['BOGUS'], 'batch code validation')
+        self.assertRaises(cubely.errors.PositionError, prod.status_add, ['P1', 'BOGUS'])
 
 
 if __name__ == '__main__':
@@ -22,6 +22,25 @@ class  FormulaTestCase(unittest.TestCase):
         self.assertEqual(form.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 12, 'check formula value')
         #self.assertEqual(sales.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 10, 'check cube original value again')
 
+    def test_1_operators(self):
+        sales = cubely.V_SALES
+        lmt(cubely.D_PROD, to, 'P1')
+        lmt(cubely.D_GEOG, to, all)
+        lmt(cubely.D_TIME, to, 'JAN')
+        double = sales + sales
+        self.assertEqual(double.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 20, 'check operator on stored cell')
+        self.assertEqual(double.get({'PROD': 'P1', 'GEOG': 'G2', 'TIME':'JAN'}), None, 'check empty cells are not computed')
+        form = cubely.F_SALESPLUS
+        sales.set({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}, 20)
+        self.assertEqual(form.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 22, 'check formula cache follows the cube')
+        sales.set({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}, 10)
+        self.assertEqual(form.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 12, 'check formula cache follows the cube 2')
+        sales.set({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}, 30)
+        sales.rollback()
+        self.assertEqual(form.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 12, 'check formula cache after rollback')
+        cells = form.get_many([{'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}, {'PROD': 'P1', 'GEOG': 'G2', 'TIME':'JAN'}])
+        self.assertEqual([cellVal for pos, cellVal in cells], [12, None], 'check formula get_many')
+
     def test_2_afterReopen(self):
         sales = cubely.V_SALES
         self.assertEqual(sales.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 10, 'check cube original value')
@@ -29,6 +48,18 @@ class  FormulaTestCase(unittest.TestCase):
         self.assertEqual(form.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 12, 'check formula value')
         self.assertEqual(sales.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 10, 'check cube original value again')
         #pass
+
+    def test_3_materialized(self):
+        sales = cubely.V_SALES
+        form = cubely.formula.create('SALESDOUBLE', '@V_SALES * 2', 'materialized formula', materialized=True)
+        self.assertEqual(form.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 20, 'check materialized value')
+        self.assertTrue(isinstance(form.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), int), 'check materialized value typed like the cube')
+        sales.set({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}, 15)
+        self.assertEqual(form.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 30, 'check materialized value refreshed')
+        sales.rollback()
+        self.assertEqual(form.get({'PROD': 'P1', 'GEOG': 'G1', 'TIME':'JAN'}), 20, 'check materialized value after rollback')
+        cubely.formula.delete('SALESDOUBLE')
+        self.assertFalse('SALESDOUBLE' in cubely.FORMULAS, 'check materialized formula deleted')
     
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
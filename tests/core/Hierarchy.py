@@ -23,13 +23,38 @@ class  HierarchyTestCase(unittest.TestCase):
         totp = cubely.D_PROD.get('TOTPROD')
         self.assertEqual('P2', hier.links['P1'], 'Check parent value')
         self.assertEqual('P2', hier.get('P1'), 'Check parent value 2')
+        self.assertEqual(['P1'], hier.children('P2'), 'Check children index')
         hier.set('P1', 'TOTPROD')
         self.assertEqual(totp.code, hier.links['P1'], 'Check change parent value')
+        self.assertEqual([], hier.children('P2'), 'Check children index after change')
+        self.assertTrue('P1' in hier.children('TOTPROD'), 'Check children index after change 2')
+        self.assertEqual(hier.depth('TOTPROD') + 1, hier.depth('P1'), 'Check depth')
+        self.assertEqual('TOTPROD', hier.ancestors('P1')[0], 'Check ancestors closure')
+        self.assertEqual(1, hier.descendants('TOTPROD')['P1'], 'Check descendants closure')
+        self.assertRaises(cubely.errors.HierarchyError, hier.set, 'TOTPROD', 'P1')
+
+    def test_2_set_many(self):
+        hier = cubely.HIERS['PROD']['STD']
+        self.assertEqual(hier.set_many([('P3', 'P2'), ('P2', 'TOTPROD')]), [], 'Check bulk links')
+        self.assertEqual(('P2', 'TOTPROD'), hier.ancestors('P3'), 'Check bulk links closure')
+        cubely.lang.check_hier(hier)
+        self.assertEqual(hier.indexedVersion, hier.version, 'Check ordering index version')
+        self.assertTrue(hier.order['TOTPROD'] < hier.order['P2'] < hier.order['P3'], 'Check ordering index')
+        version = hier.version
+        hier.set_many([('P3', 'P2'), ('P2', 'TOTPROD')])
+        hier.set('P3', 'P2')
+        self.assertEqual(hier.version, version, 'Check unchanged links keep the ordering index')
+        self.assertTrue(hier.indexed, 'Check unchanged links keep the hierarchy indexed')
+        self.assertRaises(cubely.errors.HierarchyError, hier.set_many, {'TOTPROD': 'P3'})
+        self.assertEqual([('TOTPROD', 'P3')], hier.set_many({'TOTPROD': 'P3'}, skip_invalid=True), 'Check loop skipped')
+        hier.unset('P3')
+        hier.unset('P2')
 
     def test_2_unset(self):
         hier = cubely.HIERS['PROD']['STD']
         hier.unset('P1')
         self.assertFalse(hier.links.has_key('P1'), 'Check unset position in hier')
+        self.assertFalse('P1' in hier.children('TOTPROD'), 'Check unset position in children index')
         self.assertRaises(cubely.errors.HierarchyError, hier.unset, 'P2')
 
     def test_3_delete(self):
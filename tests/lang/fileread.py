@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+import cubely
+import cubely.io
+
+# fixed lines: desc on 1-10, code on 11-15, parent on 16-20, value on 21-25
+FIXED_LINES = [
+    '* items of the stock',
+    'Total     TOT       100  ',
+    'Item one  I1   TOT  10   ',
+    'Item two  I2   TOT  20   ',
+    'Item threeI3   TOT  30   ',
+    'Item four I4   TOT  40   ',
+]
+
+
+def _get_definition(type, suffix):
+    # the desc field is read before the code field
+    definition = {
+        'type': type,
+        0: {'objectType': 'Dimension', 'objectCode': 'ITEM' + suffix, 'dataNature': 'desc'},
+        1: {'objectType': 'Dimension', 'objectCode': 'ITEM' + suffix, 'dataNature': 'code', 'metas': ['APPEND', 'MATCH']},
+        2: {'objectType': 'Hierarchy', 'objectCode': 'STD', 'dataNature': 'ITEM' + suffix},
+        3: {'objectType': 'Cube', 'objectCode': 'STOCK' + suffix},
+    }
+    if type == 'fixed':
+        for index, (start, stop) in enumerate([(1, 11), (11, 16), (16, 21), (21, 26)]):
+            definition[index]['start'] = start
+            definition[index]['stop'] = stop
+    else:
+        definition['separator'] = ';'
+    return definition
+
+
+class  FilereadTestCase(unittest.TestCase):
+    def setUp(self):
+        cubely.db.open('unittest')
+
+    def tearDown(self):
+        cubely.db.close()
+
+    def _load(self, type, lines, suffix, parallelDegree):
+        dim = cubely.dim.create('ITEM' + suffix, 'Item dimension')
+        hier = cubely.hier.create('ITEM' + suffix, 'STD')
+        cube = cubely.cube.create(['ITEM' + suffix], 'int', 'STOCK' + suffix, 'Stock cube')
+        fileHandle, fileName = tempfile.mkstemp()
+        try:
+            os.write(fileHandle, '\n'.join(lines) + '\n')
+            os.close(fileHandle)
+            # the middle of the file is inside a line
+            start, stop = cubely.io._split_file(fileName, 2)[0]
+            self.assertNotEqual(stop, os.path.getsize(fileName) // 2, 'check a line straddles the split')
+            cubely.io.fileread(fileName, _get_definition(type, suffix), parallel_degree=parallelDegree)
+        finally:
+            os.remove(fileName)
+        positions = sorted([(p.code, p.description) for p in dim.positions.values()])
+        links = sorted(hier.links.items())
+        cells = sorted([(p.code, cube.get({dim.code: p.code})) for p in dim.positions.values()])
+        return positions, links, cells
+
+    def _check_load(self, type, lines, suffix):
+        positions, links, cells = self._load(type, lines, suffix + '1', 1)
+        self.assertEqual(positions[0], (u'I1', u'Item one'), 'check desc read before code')
+        self.assertEqual(len(positions), 5, 'check comment line skipped')
+        self.assertEqual(links[0], (u'I1', u'TOT'), 'check links')
+        self.assertEqual(cells[3], (u'I4', 40), 'check cells')
+        self.assertEqual(self._load(type, lines, suffix + '2', 2), (positions, links, cells), 'check parallel read')
+
+    def test_1_fixed(self):
+        self._check_load('fixed', FIXED_LINES, 'F')
+
+    def test_2_structured(self):
+        lines = [FIXED_LINES[0]] + [';'.join([line[0:10].strip(), line[10:15].strip(), line[15:20].strip(), line[20:25].strip()])
+                                    for line in FIXED_LINES[1:]]
+        self._check_load('structured', lines, 'S')
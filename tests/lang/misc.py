@@ -30,6 +30,8 @@ class  MiscTestCase(unittest.TestCase):
         self.assertEqual(prod.status[0].code, 'P1', 'check alphabetical sort')
         sorth(prod, 'STD')
         self.assertEqual(prod.status[0].code, 'TOTPROD', 'check hierarchical sort')
+        self.assertEqual(sorted(prod.status, key=alpha_sort_key(prod))[0].code, 'P1', 'check alphabetical sort key')
+        self.assertEqual(sorted(prod.status, key=hier_sort_key(prod, 'STD'))[0].code, 'TOTPROD', 'check hierarchical sort key')
 
     def test_3_exists(self):
         self.assertFalse(exists('prod247'), 'check non existing object')